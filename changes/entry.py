@@ -0,0 +1,158 @@
+from datetime import datetime, timedelta
+from enum import IntEnum
+
+from mongoengine import Document, IntField, ObjectIdField, DateTimeField
+from pymongo import ReturnDocument
+
+
+# Change log of subscriber channel lists, seq grows monotonically over all records
+# subscriber is None for modifications of the stream itself, they concern every subscriber with the stream;
+# removals of a stream are recorded per subscriber that had it, see record_for_holders()
+# Recording a change also bumps the playlist_seq of the subscribers concerned, their playlists are stale
+class ChannelChange(Document):
+    COUNTERS_COLLECTION = 'counters'
+    SUBSCRIBERS_COLLECTION = 'subscribers'
+    SUBSCRIBER_LIST_FIELDS = ('streams', 'own_streams')
+    SUBSCRIBER_PLAYLIST_SEQ_FIELD = 'playlist_seq'
+    COUNTER_ID = 'channel_changes'
+    COUNTER_SEQ_FIELD = 'seq'
+    COUNTER_COMPACTED_FIELD = 'compacted'
+    # seq is taken before the insert, newer records are left for the next read so none is skipped
+    SETTLE_TIME = timedelta(seconds=1)
+
+    class Action(IntEnum):
+        ADDED = 0
+        REMOVED = 1
+        MODIFIED = 2
+
+        @classmethod
+        def choices(cls):
+            return [(choice, choice.name) for choice in cls]
+
+        @classmethod
+        def coerce(cls, item):
+            return cls(int(item)) if not isinstance(item, cls) else item
+
+        def __str__(self):
+            return str(self.value)
+
+    meta = {'collection': 'channel_changes', 'allow_inheritance': False, 'auto_create_index': True,
+            'indexes': ['seq', ('subscriber', 'seq'), 'created_date']}
+
+    seq = IntField(required=True, unique=True)
+    subscriber = ObjectIdField(default=None)
+    stream = ObjectIdField(required=True)
+    action = IntField(min_value=Action.ADDED, max_value=Action.MODIFIED, required=True)
+    created_date = DateTimeField(default=datetime.now)
+
+    @classmethod
+    def record(cls, action: Action, stream_ids, subscriber_id=None):
+        stream_ids = list(stream_ids)
+        if not stream_ids:
+            return
+
+        cls._insert(action, [(subscriber_id, sid) for sid in stream_ids])
+        if subscriber_id is not None:
+            cls.touch_subscribers([subscriber_id])
+        elif action == ChannelChange.Action.MODIFIED:
+            cls._get_subscribers().update_many(ChannelChange._make_holders_query(stream_ids),
+                                               {'$inc': {ChannelChange.SUBSCRIBER_PLAYLIST_SEQ_FIELD: 1}})
+
+    # subscriber id -> ids of stream_ids in its lists, read before a delete pulls the streams from the lists
+    @classmethod
+    def find_holders(cls, stream_ids) -> dict:
+        stream_ids = list(stream_ids)
+        if not stream_ids:
+            return {}
+
+        wanted = set(stream_ids)
+        projection = {field: True for field in ChannelChange.SUBSCRIBER_LIST_FIELDS}
+        holders = {}
+        for doc in cls._get_subscribers().find(ChannelChange._make_holders_query(stream_ids), projection):
+            holders[doc['_id']] = [sid for field in ChannelChange.SUBSCRIBER_LIST_FIELDS
+                                   for sid in doc.get(field) or [] if sid in wanted]
+        return holders
+
+    # One record of action per subscriber and stream it had, holders as returned by find_holders()
+    @classmethod
+    def record_for_holders(cls, action: Action, holders: dict):
+        pairs = [(subscriber_id, sid) for subscriber_id, stream_ids in holders.items() for sid in stream_ids]
+        if pairs:
+            cls._insert(action, pairs)
+            cls.touch_subscribers(holders.keys())
+
+    # Bumps the playlist_seq of the subscribers, for changes of their lists written without record()
+    @classmethod
+    def touch_subscribers(cls, subscriber_ids):
+        subscriber_ids = list(subscriber_ids)
+        if subscriber_ids:
+            cls._get_subscribers().update_many({'_id': {'$in': subscriber_ids}},
+                                               {'$inc': {ChannelChange.SUBSCRIBER_PLAYLIST_SEQ_FIELD: 1}})
+
+    # Records up to this seq were dropped by compact()
+    @classmethod
+    def compacted_seq(cls) -> int:
+        counter = cls._get_counters().find_one({'_id': ChannelChange.COUNTER_ID})
+        return counter.get(ChannelChange.COUNTER_COMPACTED_FIELD, 0) if counter else 0
+
+    # Newest seq whose record and all records before it are written, deltas are read up to it
+    @classmethod
+    def settled_seq(cls) -> int:
+        last = cls._get_collection().find_one({'created_date': {'$lte': datetime.now() - ChannelChange.SETTLE_TIME}},
+                                              {'seq': True}, sort=[('seq', -1)])
+        return last['seq'] if last else cls.compacted_seq()
+
+    # Raw records in (seq, until] of one subscriber and of the streams themselves, oldest first
+    # stream_ids narrows the modifications of streams to the subscriber's streams
+    @classmethod
+    def find_since(cls, seq: int, until: int, subscriber_id, stream_ids=None):
+        query = {'seq': {'$gt': seq, '$lte': until}}
+        if stream_ids is None:
+            query['subscriber'] = {'$in': [subscriber_id, None]}
+        else:
+            query['$or'] = [{'subscriber': subscriber_id},
+                            {'subscriber': None, 'stream': {'$in': list(stream_ids)}}]
+        return cls._get_collection().find(query, {'_id': False, 'seq': True, 'subscriber': True, 'stream': True,
+                                                  'action': True}).sort('seq', 1)
+
+    # Drops records older than before, clients behind them get a snapshot, returns the number dropped
+    @classmethod
+    def compact(cls, before: datetime) -> int:
+        last = cls._get_collection().find_one({'created_date': {'$lt': before}}, {'seq': True},
+                                              sort=[('seq', -1)])
+        if last is None:
+            return 0
+
+        cls._get_counters().update_one({'_id': ChannelChange.COUNTER_ID},
+                                       {'$max': {ChannelChange.COUNTER_COMPACTED_FIELD: last['seq']}}, upsert=True)
+        return cls._get_collection().delete_many({'seq': {'$lte': last['seq']}}).deleted_count
+
+    # private
+    @classmethod
+    def _get_counters(cls):
+        return cls._get_db()[ChannelChange.COUNTERS_COLLECTION]
+
+    # (subscriber id, stream id) pairs, one seq each
+    @classmethod
+    def _insert(cls, action: Action, pairs: list):
+        created_date = datetime.now()
+        first = cls._reserve(len(pairs))
+        cls._get_collection().insert_many(
+            [{'seq': first + index, 'subscriber': subscriber_id, 'stream': sid, 'action': int(action),
+              'created_date': created_date} for index, (subscriber_id, sid) in enumerate(pairs)], ordered=False)
+
+    @classmethod
+    def _get_subscribers(cls):
+        return cls._get_db()[ChannelChange.SUBSCRIBERS_COLLECTION]
+
+    @staticmethod
+    def _make_holders_query(stream_ids: list) -> dict:
+        return {'$or': [{field: {'$in': stream_ids}} for field in ChannelChange.SUBSCRIBER_LIST_FIELDS]}
+
+    # First of count new sequence numbers
+    @classmethod
+    def _reserve(cls, count: int) -> int:
+        counter = cls._get_counters().find_one_and_update({'_id': ChannelChange.COUNTER_ID},
+                                                          {'$inc': {ChannelChange.COUNTER_SEQ_FIELD: count}},
+                                                          upsert=True, return_document=ReturnDocument.AFTER)
+        return counter[ChannelChange.COUNTER_SEQ_FIELD] - count + 1
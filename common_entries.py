@@ -4,7 +4,24 @@ from mongoengine import EmbeddedDocument, StringField, IntField, ListField, Embe
 import app.common.constants as constants
 
 
-class Url(EmbeddedDocument):
+# Tells the owning document about changes made in place, owners react in _on_embedded_changed()
+class TrackedEmbeddedDocument(EmbeddedDocument):
+    meta = {'abstract': True}
+
+    def _mark_as_changed(self, key):
+        super(TrackedEmbeddedDocument, self)._mark_as_changed(key)
+        self._on_embedded_changed()
+
+    def _on_embedded_changed(self):
+        try:
+            notify = getattr(self._instance, '_on_embedded_changed', None)
+        except ReferenceError:  # owner is gone
+            return
+        if notify is not None:
+            notify()
+
+
+class Url(TrackedEmbeddedDocument):
     meta = {'allow_inheritance': True, 'auto_create_index': False}
 
     _next_url_id = 0
@@ -19,7 +36,7 @@ class Url(EmbeddedDocument):
         return current_value
 
 
-class HttpProxy(EmbeddedDocument):
+class HttpProxy(TrackedEmbeddedDocument):
     INVALID_URL = str()
     DEFAULT_USER = str()
     DEFAULT_PASSWORD = str()
@@ -49,15 +66,15 @@ class OutputUrl(Url):
 
 
 # {"urls": [{"id": 81,"uri": "tcp://localhost:1935"}]}
-class InputUrls(EmbeddedDocument):
+class InputUrls(TrackedEmbeddedDocument):
     urls = ListField(EmbeddedDocumentField(InputUrl))
 
 
-class OutputUrls(EmbeddedDocument):
+class OutputUrls(TrackedEmbeddedDocument):
     urls = ListField(EmbeddedDocumentField(OutputUrl))
 
 
-class Logo(EmbeddedDocument):
+class Logo(TrackedEmbeddedDocument):
     path = StringField(default=constants.INVALID_LOGO_PATH, required=True)
     x = IntField(default=constants.DEFAULT_LOGO_X, required=True)
     y = IntField(default=constants.DEFAULT_LOGO_Y, required=True)
@@ -70,7 +87,7 @@ class Logo(EmbeddedDocument):
         return {'path': self.path, 'position': '{0},{1}'.format(self.x, self.y), 'alpha': self.alpha}
 
 
-class Size(EmbeddedDocument):
+class Size(TrackedEmbeddedDocument):
     width = IntField(default=constants.INVALID_WIDTH, required=True)
     height = IntField(default=constants.INVALID_HEIGHT, required=True)
 
@@ -81,7 +98,7 @@ class Size(EmbeddedDocument):
         return '{0}x{1}'.format(self.width, self.height)
 
 
-class Rational(EmbeddedDocument):
+class Rational(TrackedEmbeddedDocument):
     num = IntField(default=constants.INVALID_RATIO_NUM, required=True)
     den = IntField(default=constants.INVALID_RATIO_DEN, required=True)
 
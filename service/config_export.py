@@ -0,0 +1,79 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice, repeat
+from types import SimpleNamespace
+
+from app.common.stream.entry import IStream
+
+# stored fields configs are not made from, left out of the export query
+EXPORT_EXCLUDED_FIELDS = ('render_version', 'playlist_extinf', 'playlist_fragment', 'device_links')
+EXPORT_CHUNK_SIZE = 500
+CONFIG_FILE_NAME = 'config.json'
+
+
+# (stream id, stream type, config JSON) of the stored streams in ids and in the order of ids, loaded with one
+# query per chunk and built by worker processes from the raw documents; settings are the ServiceSettings values
+# configs are made from, workers=1 builds in this process
+def iter_stream_configs(ids, settings: dict, workers=None, chunk_size=EXPORT_CHUNK_SIZE):
+    chunks = _iter_doc_chunks(ids, chunk_size)
+    if workers == 1:
+        for chunk in chunks:
+            yield from _build_configs(settings, chunk)
+        return
+
+    with ProcessPoolExecutor(workers) as pool:
+        for configs in pool.map(_build_configs, repeat(settings), chunks):
+            yield from configs
+
+
+# Newline-delimited JSON into a binary file object, returns the number of configs written
+def write_ndjson(output, configs) -> int:
+    count = 0
+    for _, _, config_json in configs:
+        output.write(config_json)
+        output.write(b'\n')
+        count += 1
+    return count
+
+
+# <directory>/<type>/<id>/config.json per stream, the feedback directory layout of streams, replaced atomically
+def write_config_files(directory: str, configs) -> int:
+    count = 0
+    for sid, stream_type, config_json in configs:
+        stream_directory = os.path.join(os.path.expanduser(directory), str(stream_type), sid)
+        os.makedirs(stream_directory, exist_ok=True)
+        path = os.path.join(stream_directory, CONFIG_FILE_NAME)
+        temp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'wb') as file:
+            file.write(config_json)
+        os.replace(temp_path, path)
+        count += 1
+    return count
+
+
+def _iter_chunks(items, size: int):
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# raw documents of a chunk of ids at a time, $in returns them in any order
+def _iter_doc_chunks(ids, size: int):
+    collection = IStream._get_collection()
+    projection = {field: False for field in EXPORT_EXCLUDED_FIELDS}
+    for chunk in _iter_chunks(ids, size):
+        docs = {doc['_id']: doc for doc in collection.find({'_id': {'$in': chunk}}, projection)}
+        yield [docs[sid] for sid in chunk if sid in docs]
+
+
+def _build_configs(settings: dict, docs: list) -> list:
+    server_settings = SimpleNamespace(**settings)
+    result = []
+    for doc in docs:
+        stream = IStream._from_son(doc)
+        stream.set_server_settings(server_settings)
+        result.append((stream.get_id(), int(stream.get_type()), stream.config_json()))
+    return result
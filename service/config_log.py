@@ -0,0 +1,74 @@
+import json
+from datetime import datetime
+
+from mongoengine import Document, ObjectIdField, StringField, DateTimeField
+from pymongo import UpdateOne
+
+from app.common.stream.entry import ConfigFields
+from app.common.utils.config_patch import make_config_patch
+
+
+# Config the streamer of a service applied last for each of its streams, the hash skips unchanged streams and
+# the config is what patches are made against
+class AppliedConfig(Document):
+    meta = {'collection': 'applied_configs', 'allow_inheritance': False, 'auto_create_index': True,
+            'indexes': [{'fields': ['service', 'stream'], 'unique': True}]}
+
+    service = ObjectIdField(required=True)
+    stream = ObjectIdField(required=True)
+    hash = StringField(required=True)
+    config = StringField(required=True)  # compact JSON as applied
+    applied_date = DateTimeField(default=datetime.now)
+
+    # stream id -> (hash, config JSON)
+    @classmethod
+    def find_applied(cls, service_id, stream_ids) -> dict:
+        cursor = cls._get_collection().find({'service': service_id, 'stream': {'$in': list(stream_ids)}},
+                                            {'_id': False, 'stream': True, 'hash': True, 'config': True})
+        return {doc['stream']: (doc['hash'], doc['config']) for doc in cursor}
+
+    @classmethod
+    def record(cls, service_id, updates):
+        applied_date = datetime.now()
+        requests = [UpdateOne({'service': service_id, 'stream': update.stream_id},
+                              {'$set': {'hash': update.hash, 'config': update.config_json.decode(),
+                                        'applied_date': applied_date}}, upsert=True) for update in updates]
+        if requests:
+            cls._get_collection().bulk_write(requests, ordered=False)
+
+    # All streams of the service when stream_ids is None, their next update is a full config
+    @classmethod
+    def forget(cls, service_id, stream_ids=None):
+        query = {'service': service_id}
+        if stream_ids is not None:
+            query['stream'] = {'$in': list(stream_ids)}
+        cls._get_collection().delete_many(query)
+
+
+# What a streamer needs to reach the current config of one stream: the full config or a patch of the applied one
+class ConfigUpdate:
+    HASH_FIELD = 'hash'
+    CONFIG_FIELD = 'config'
+    PATCH_FIELD = 'patch'
+
+    __slots__ = ('stream_id', 'hash', 'config', 'config_json', 'patch')
+
+    def __init__(self, stream, applied_config_json=None):
+        self.stream_id = stream.id
+        self.hash = stream.config_hash()
+        self.config = stream.config()
+        self.config_json = stream.config_json()
+        self.patch = None
+        if applied_config_json is not None:
+            self.patch = make_config_patch(json.loads(applied_config_json), self.config)
+
+    def is_patch(self) -> bool:
+        return self.patch is not None
+
+    def to_dict(self) -> dict:
+        result = {ConfigFields.ID_FIELD: str(self.stream_id), ConfigUpdate.HASH_FIELD: self.hash}
+        if self.patch is not None:
+            result[ConfigUpdate.PATCH_FIELD] = self.patch
+        else:
+            result[ConfigUpdate.CONFIG_FIELD] = self.config
+        return result
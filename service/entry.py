@@ -1,11 +1,28 @@
+import secrets
+import time
+from datetime import datetime
 from enum import IntEnum
+from hashlib import md5
 
+from bson.objectid import ObjectId
+from pymongo import InsertOne, UpdateOne
 from mongoengine import Document, ListField, EmbeddedDocumentField, ReferenceField, EmbeddedDocument, IntField, \
-    StringField, PULL
+    StringField, DateTimeField, PULL, ValidationError
 
 import app.common.constants as constants
+from app.common.changes.entry import ChannelChange
 from app.common.common_entries import HostAndPort
-from app.common.stream.entry import IStream
+from app.common.service.config_export import iter_stream_configs, write_ndjson, write_config_files
+from app.common.service.config_log import AppliedConfig, ConfigUpdate
+from app.common.stream.entry import IStream, HardwareStream, ProxyStream, RelayStream, EncodeStream, \
+    TimeshiftPlayerStream, TimeshiftRecorderStream, CatchupStream, TestLifeStream, VodRelayStream, VodEncodeStream, \
+    ProxyVodStream, CodRelayStream, CodEncodeStream, EventStream, StreamFields
+from app.common.utils.list_index import ListIndex
+from app.common.utils.m3u_parser import M3uParser
+from app.common.utils.playlist import PLAYLIST_HEADER, DEFAULT_CHUNK_SIZE, PLAYLIST_ENCODINGS, encode_chunks, \
+    compress_playlist
+from app.common.utils.playlist_store import PlaylistStore
+from app.common.utils.url_signing import DeviceUrlSigner, DeviceUrlVerifier
 
 
 # #EXTM3U
@@ -34,6 +51,18 @@ class ProviderPair(EmbeddedDocument):
     role = IntField(min_value=Roles.READ, max_value=Roles.ADMIN, default=Roles.ADMIN)
 
 
+class SigningKey(EmbeddedDocument):
+    KEY_ID_LENGTH = 8
+    SECRET_LENGTH = 32
+
+    kid = StringField(required=True, default=lambda: secrets.token_hex(SigningKey.KEY_ID_LENGTH))
+    secret = StringField(required=True, default=lambda: secrets.token_hex(SigningKey.SECRET_LENGTH))
+    created_date = DateTimeField(default=datetime.now)
+
+    def get_secret(self) -> bytes:
+        return bytes.fromhex(self.secret)
+
+
 class ServiceSettings(Document):
     DEFAULT_SERVICE_NAME = 'Service'
     MIN_SERVICE_NAME_LENGTH = 3
@@ -58,6 +87,25 @@ class ServiceSettings(Document):
     DEFAULT_SERVICE_CODS_HOST = 'localhost'
     DEFAULT_SERVICE_CODS_PORT = 6001
 
+    DEFAULT_IMPORT_BATCH_SIZE = 1000
+    DEFAULT_SYNC_KEY_FIELDS = ('tvg-id', 'link')
+    DEFAULT_M3U_SOURCE = 'm3u'
+    PLAYLIST_STORE_KEY_TEMPLATE = 'service_{0}'
+    # the newest key signs, older ones still verify until rotated out
+    MAX_SIGNING_KEYS = 2
+    DEFAULT_SIGNED_URL_TTL = 7 * 24 * 3600
+    # m3u entry key -> stream field
+    M3U_STREAM_FIELDS = (('title', 'name'), ('tvg-id', 'tvg_id'), ('tvg-name', 'tvg_name'), ('tvg-logo', 'tvg_logo'),
+                         ('tvg-group', 'group'))
+    STREAM_CLASSES = {constants.StreamType.PROXY: ProxyStream, constants.StreamType.VOD_PROXY: ProxyVodStream,
+                      constants.StreamType.RELAY: RelayStream, constants.StreamType.ENCODE: EncodeStream,
+                      constants.StreamType.TIMESHIFT_PLAYER: TimeshiftPlayerStream,
+                      constants.StreamType.TIMESHIFT_RECORDER: TimeshiftRecorderStream,
+                      constants.StreamType.CATCHUP: CatchupStream, constants.StreamType.TEST_LIFE: TestLifeStream,
+                      constants.StreamType.VOD_RELAY: VodRelayStream, constants.StreamType.VOD_ENCODE: VodEncodeStream,
+                      constants.StreamType.COD_RELAY: CodRelayStream, constants.StreamType.COD_ENCODE: CodEncodeStream,
+                      constants.StreamType.EVENT: EventStream}
+
     meta = {'collection': 'services', 'auto_create_index': False}
 
     streams = ListField(ReferenceField(IStream, reverse_delete_rule=PULL), default=[])
@@ -84,6 +132,14 @@ class ServiceSettings(Document):
     vods_directory = StringField(default=DEFAULT_VODS_DIR_PATH)
     cods_directory = StringField(default=DEFAULT_CODS_DIR_PATH)
 
+    signing_keys = ListField(EmbeddedDocumentField(SigningKey), default=[])
+
+    def __init__(self, *args, **kwargs):
+        super(ServiceSettings, self).__init__(*args, **kwargs)
+        self._streams_index = ListIndex(lambda stream: stream.id)
+        self._streams_by_str_id_index = ListIndex(lambda stream: stream.get_id())
+        self._providers_index = ListIndex(lambda pair: IStream.ref_id(pair._data.get('user')))
+
     def get_host(self) -> str:
         return str(self.host)
 
@@ -106,21 +162,215 @@ class ServiceSettings(Document):
         return url.replace(self.cods_directory, self.get_cods_host())
 
     def generate_playlist(self) -> str:
-        result = '#EXTM3U\n'
-        for stream in self.streams:
-            result += stream.generate_playlist(False)
+        return ''.join(self.iter_playlist())
+
+    def iter_playlist(self):
+        yield PLAYLIST_HEADER
+        for stream in self.get_streams(*IStream.PLAYLIST_FIELDS):
+            yield from stream.iter_playlist(False)
+
+    # Streams loaded with one query, fields limits the loaded fields
+    def get_streams(self, *fields) -> list:
+        return IStream.load_by_refs(self._data['streams'], *fields)
+
+    # Encoded playlist for streaming responses
+    def generate_playlist_chunks(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        return encode_chunks(self.iter_playlist(), chunk_size)
+
+    # Changes with the stream list and every save() of a listed stream, nothing is rendered
+    def playlist_version(self) -> str:
+        streams = [IStream.ref_id(ref) for ref in self._data['streams']]
+        versions = {}
+        for row in IStream._get_collection().find({'_id': {'$in': streams}}, {'render_version': 1}):
+            versions[row['_id']] = row.get('render_version', 0)
+
+        h = md5()
+        for sid in streams:
+            h.update('{0}:{1};'.format(sid, versions.get(sid)).encode())
+        return h.hexdigest()
+
+    def get_playlist_store(self) -> PlaylistStore:
+        return PlaylistStore.open(self.playlists_directory)
+
+    def get_playlist_store_key(self) -> str:
+        return ServiceSettings.PLAYLIST_STORE_KEY_TEMPLATE.format(self.id)
+
+    # Renders into the shared store unless the stored playlist is of the current version, returns the etag
+    # compress also stores gzip/zstd forms, see StoredPlaylist.negotiate
+    def publish_playlist(self, compress=False) -> str:
+        store = self.get_playlist_store()
+        key = self.get_playlist_store_key()
+        version = self.playlist_version()
+        stored = store.get(key)
+        if stored is not None and stored.version == version and (
+                not compress or all(encoding in stored.sections for encoding in PLAYLIST_ENCODINGS)):
+            return stored.etag
+
+        if not compress:
+            return store.publish(key, self.generate_playlist_chunks(), version)
+
+        content = b''.join(self.generate_playlist_chunks())
+        encoded = {encoding: compress_playlist(content, encoding) for encoding in PLAYLIST_ENCODINGS}
+        return store.publish(key, content, version, **encoded)
+
+    def get_published_playlist(self):
+        return self.get_playlist_store().get(self.get_playlist_store_key())
+
+    def make_stream(self, stream_type: constants.StreamType) -> IStream:
+        return ServiceSettings.STREAM_CLASSES[stream_type].make_stream(self)
+
+    def make_stream_from_m3u_entry(self, entry, stream_type: constants.StreamType) -> IStream:
+        stream = self.make_stream(stream_type)
+        ServiceSettings._apply_m3u_values(stream, ServiceSettings._m3u_entry_values(entry))
+        return stream
+
+    # Create streams from parsed m3u entries with batched inserts, every batch is referenced by the service right
+    # after its insert so a failing batch leaves no orphans behind; returns the streams and the number of entries
+    # skipped as invalid, entries may be a generator. The streams are tagged with source, sync_m3u_entries() of
+    # the same source updates and deletes them
+    def import_m3u_entries(self, entries, stream_type: constants.StreamType,
+                           batch_size=DEFAULT_IMPORT_BATCH_SIZE, source=DEFAULT_M3U_SOURCE) -> dict:
+        imported = []
+        skipped = 0
+        batch = []
+        for entry in entries:
+            stream = self._make_new_stream_from_m3u_entry(entry, stream_type, source)
+            if stream is None:
+                skipped += 1
+                continue
+
+            batch.append(stream)
+            if len(batch) >= batch_size:
+                self._import_streams(batch)
+                imported.extend(batch)
+                batch = []
+
+        if batch:
+            self._import_streams(batch)
+            imported.extend(batch)
+        return {'imported': imported, 'skipped': skipped}
+
+    # Apply a re-published playlist to the streams of stream_type imported from source before: new entries are
+    # inserted, changed ones updated and missing ones deleted; streams made by hand or imported from another source
+    # are left alone
+    def sync_m3u_entries(self, entries, stream_type: constants.StreamType, key_fields=DEFAULT_SYNC_KEY_FIELDS,
+                         source=DEFAULT_M3U_SOURCE) -> dict:
+        stream_class = ServiceSettings.STREAM_CLASSES[stream_type]
+        link_field = ServiceSettings._m3u_link_field(stream_type)
+        ids = [IStream.ref_id(ref) for ref in self._data['streams']]
+
+        # key -> [(id, values)] of the stored streams, several streams may share a key
+        existing = {}
+        projection = [field for _, field in ServiceSettings.M3U_STREAM_FIELDS] + [link_field]
+        for doc in IStream._get_collection().find({'_id': {'$in': ids}, '_cls': stream_class._class_name,
+                                                   'm3u_source': source}, projection):
+            values = ServiceSettings._m3u_document_values(doc, link_field)
+            key = tuple(values[field] for field in key_fields)
+            existing.setdefault(key, []).append((doc['_id'], values))
+
+        inserted = []
+        changed = {}
+        unchanged = 0
+        for entry in entries:
+            values = ServiceSettings._m3u_entry_values(entry)
+            candidates = existing.get(tuple(values[field] for field in key_fields))
+            if not candidates:
+                stream = self._make_new_stream_from_m3u_entry(entry, stream_type, source)
+                if stream is not None:
+                    inserted.append(stream)
+                continue
+
+            sid, stored = candidates.pop()
+            if stored == values:
+                unchanged += 1
+            else:
+                changed[sid] = values
+
+        deleted = [sid for candidates in existing.values() for sid, _ in candidates]
+
+        requests = [InsertOne(stream.to_mongo()) for stream in inserted]
+        updated = []
+        for stream in stream_class.objects(id__in=list(changed.keys())):
+            ServiceSettings._apply_m3u_values(stream, changed[stream.id])
+            stream.set_server_settings(self)
+            stream.fixup_output_urls()
+            stream.refresh_render()
+            try:
+                stream.validate()
+            except ValidationError:
+                continue
+            set_data, unset_data = stream._delta()
+            update = {}
+            if set_data:
+                update['$set'] = set_data
+            if unset_data:
+                update['$unset'] = unset_data
+            if update:
+                requests.append(UpdateOne({'_id': stream.id}, update))
+                updated.append(stream.id)
+        if requests:
+            try:
+                IStream._get_collection().bulk_write(requests, ordered=False)
+                if inserted:
+                    ServiceSettings._get_collection().update_one({'_id': self.id}, {
+                        '$push': {'streams': {'$each': [stream.id for stream in inserted]}}})
+            except Exception:
+                # an unordered or interrupted write may have inserted part of the new streams
+                if inserted:
+                    IStream._get_collection().delete_many({'_id': {'$in': [stream.id for stream in inserted]}})
+                raise
+            for stream in inserted:
+                stream._created = False
+                stream._clear_changed_fields()
+
+        holders = ChannelChange.find_holders(deleted)
+        if deleted:
+            try:
+                IStream._get_collection().delete_many({'_id': {'$in': deleted}, 'm3u_source': source})
+            except Exception:
+                remaining = {doc['_id'] for doc in IStream._get_collection().find({'_id': {'$in': deleted}},
+                                                                                   {'_id': True})}
+                ServiceSettings._pull_deleted_streams([sid for sid in deleted if sid not in remaining])
+                raise
+            ServiceSettings._pull_deleted_streams(deleted)
+        if deleted or inserted:
+            removed = set(deleted)
+            streams = [ref for ref in self._data['streams'] if IStream.ref_id(ref) not in removed]
+            self._set_stored_streams(streams + inserted)
+
+        # bulk writes bypass IStream.save() and delete() as well
+        ChannelChange.record(ChannelChange.Action.MODIFIED, updated)
+        ChannelChange.record_for_holders(ChannelChange.Action.REMOVED, holders)
+        return {'inserted': len(inserted), 'updated': len(updated), 'deleted': len(deleted), 'unchanged': unchanged}
+
+    def rotate_signing_key(self) -> SigningKey:
+        key = SigningKey()
+        self.signing_keys = [key] + self.signing_keys[:ServiceSettings.MAX_SIGNING_KEYS - 1]
+        self.save()
+        return key
+
+    # kid -> secret of the keys that still verify
+    def get_signing_keys(self) -> dict:
+        return {key.kid: key.get_secret() for key in self.signing_keys}
+
+    # Made once in the load balancer, verify() then needs no database access
+    def make_url_verifier(self) -> DeviceUrlVerifier:
+        return DeviceUrlVerifier(self.get_signing_keys())
 
-        return result
+    def make_url_signer(self, ttl=DEFAULT_SIGNED_URL_TTL) -> DeviceUrlSigner:
+        key = self.signing_keys[0] if self.signing_keys else self.rotate_signing_key()
+        return DeviceUrlSigner(key.kid, key.get_secret(), int(time.time()) + ttl)
 
     def add_provider(self, user: ProviderPair):
         self.providers.append(user)
+        self._providers_index.invalidate()
         self.save()
 
     def remove_provider(self, provider):
-        for user in self.providers:
-            if user.user == provider:
-                self.providers.remove(user)
-                break
+        position = self._providers_index.find(self.providers, IStream.ref_id(provider))
+        if position >= 0:
+            del self.providers[position]
+            self._providers_index.invalidate()
         self.save()
 
     def add_subscriber(self, subscriber):
@@ -132,13 +382,159 @@ class ServiceSettings(Document):
         self.save()
 
     def find_stream_settings_by_id(self, sid):
-        for stream in self.streams:
-            if stream.id == sid:
-                return stream
-
-        return None
+        return self._streams_index.get(self.streams, sid)
+
+    # Runtime status of many streams at once, statuses are HardwareStream.update_runtime_fields() payloads
+    # invalid counts payloads of another type, of a stream without runtime fields or with missing or bad values
+    def update_streams_runtime_fields(self, statuses) -> dict:
+        streams = self.streams
+        updated = 0
+        invalid = 0
+        unknown = []
+        for params in statuses:
+            sid = params.get(StreamFields.ID)
+            stream = self._streams_by_str_id_index.get(streams, sid)
+            if stream is None:
+                unknown.append(sid)
+                continue
+
+            if not isinstance(stream, HardwareStream) or stream.get_type() != params.get(StreamFields.TYPE):
+                invalid += 1
+                continue
+
+            try:
+                stream._apply_runtime_fields(params)
+            except (KeyError, ValueError, TypeError):
+                invalid += 1
+                continue
+            updated += 1
+
+        return {'updated': updated, 'invalid': invalid, 'unknown': unknown}
+
+    # Updates bringing the streamer at host to the current configs of streams (all streams by default), streams
+    # whose applied config hash is current are left out, send them and then mark_configs_applied(updates)
+    def make_config_updates(self, streams=None) -> list:
+        streams = self.streams if streams is None else streams
+        applied = AppliedConfig.find_applied(self.id, [stream.id for stream in streams])
+        updates = []
+        for stream in streams:
+            stream.set_server_settings(self)
+            state = applied.get(stream.id)
+            if state is None:
+                updates.append(ConfigUpdate(stream))
+            elif state[0] != stream.config_hash():
+                updates.append(ConfigUpdate(stream, state[1]))
+        return updates
+
+    def mark_configs_applied(self, updates):
+        AppliedConfig.record(self.id, updates)
+
+    # Streamer lost its state (restarted, replaced), the next updates are full configs
+    def forget_applied_configs(self, stream_ids=None):
+        AppliedConfig.forget(self.id, stream_ids)
+
+    # Configs of all streams as newline-delimited JSON into a binary file object, for pipelining to the streamer,
+    # returns the number written; streams are loaded with one query and their configs built by worker processes
+    def export_configs(self, output, workers=None) -> int:
+        return write_ndjson(output, self._iter_exported_configs(workers))
+
+    # <directory>/<type>/<id>/config.json per stream for cold starts, directory is a path on this host
+    # (feedback_directory is one on the streamer host)
+    def export_config_files(self, directory: str, workers=None) -> int:
+        return write_config_files(directory, self._iter_exported_configs(workers))
 
     def delete(self, *args, **kwargs):
         for stream in self.streams:
             stream.delete()
+        AppliedConfig.forget(self.id)
         return super(ServiceSettings, self).delete(*args, **kwargs)
+
+    # private
+    def _iter_exported_configs(self, workers):
+        # raw references, nothing is dereferenced one by one
+        ids = [IStream.ref_id(ref) for ref in self._data.get('streams') or []]
+        settings = {field: getattr(self, field) for field in IStream.SETTINGS_CONFIG_FIELDS}
+        return iter_stream_configs(ids, settings, workers)
+
+    @staticmethod
+    def _m3u_link_field(stream_type: constants.StreamType) -> str:
+        if stream_type == constants.StreamType.PROXY or stream_type == constants.StreamType.VOD_PROXY:
+            return 'output'
+        return 'input'
+
+    @staticmethod
+    def _m3u_entry_values(entry) -> dict:
+        # what a stream made from the entry stores, keyed like the entry
+        values = {'link': entry['link']}
+        for key, field in ServiceSettings.M3U_STREAM_FIELDS:
+            value = entry[key]
+            if value == M3uParser.UNKNOWN_VALUE:
+                value = IStream._fields[field].default
+            elif key == 'title':
+                value = value.strip()
+            values[key] = value
+        return values
+
+    @staticmethod
+    def _m3u_document_values(doc: dict, link_field: str) -> dict:
+        urls = doc.get(link_field, {}).get('urls')
+        values = {'link': urls[0]['uri'] if urls else None}
+        for key, field in ServiceSettings.M3U_STREAM_FIELDS:
+            values[key] = doc.get(field, IStream._fields[field].default)
+        return values
+
+    @staticmethod
+    def _apply_m3u_values(stream: IStream, values: dict):
+        urls = getattr(stream, ServiceSettings._m3u_link_field(stream.get_type())).urls
+        urls[0].uri = values['link']
+        for key, field in ServiceSettings.M3U_STREAM_FIELDS:
+            setattr(stream, field, values[key])
+
+    def _make_new_stream_from_m3u_entry(self, entry, stream_type: constants.StreamType, source: str):
+        stream = self.make_stream_from_m3u_entry(entry, stream_type)
+        stream.m3u_source = source
+        # ids are known before the insert so output urls are final in the first write
+        stream.id = ObjectId()
+        stream.fixup_output_urls()
+        stream.refresh_render()
+        try:
+            stream.validate()
+        except ValidationError:
+            return None
+        return stream
+
+    # bulk deletes bypass Document.delete(), apply the PULL rules of the references by hand
+    @staticmethod
+    def _pull_deleted_streams(ids: list):
+        if not ids:
+            return
+        for (document, field), rule in IStream._meta['delete_rules'].items():
+            if rule == PULL:
+                document._get_collection().update_many({field: {'$in': ids}}, {'$pull': {field: {'$in': ids}}})
+
+    def _set_stored_streams(self, streams: list):
+        # the list is already stored, keep the next save() from rewriting it
+        changed = 'streams' in self._changed_fields
+        self.streams = streams
+        self._streams_index.invalidate()
+        self._streams_by_str_id_index.invalidate()
+        if not changed and 'streams' in self._changed_fields:
+            self._changed_fields.remove('streams')
+
+    def _import_streams(self, streams: list):
+        ids = [stream.id for stream in streams]
+        try:
+            self._insert_streams(streams)
+            ServiceSettings._get_collection().update_one({'_id': self.id}, {'$push': {'streams': {'$each': ids}}})
+        except Exception:
+            # an unordered or interrupted insert may have written part of the batch
+            IStream._get_collection().delete_many({'_id': {'$in': ids}})
+            raise
+        self._set_stored_streams(self._data['streams'] + streams)
+
+    @staticmethod
+    def _insert_streams(streams: list):
+        IStream._get_collection().insert_many([stream.to_mongo() for stream in streams])
+        for stream in streams:
+            stream._created = False
+            stream._clear_changed_fields()
@@ -0,0 +1,96 @@
+import heapq
+import math
+from array import array
+from collections import Counter
+
+from app.common.stream.entry import HardwareStream, StreamStatus
+
+
+# Runtime fields of the hardware streams of many services packed into columns, every (service, stream type)
+# group is one contiguous slice, so sums, histograms and top-k run over array slices instead of to_dict() calls
+class FleetHealth:
+    CPU = 'cpu'
+    RSS = 'rss'
+    IDLE_RATIO = 'idle_ratio'
+    COLUMNS = (CPU, RSS, IDLE_RATIO)
+    STREAMS_FIELD = 'streams'
+    SERVICE_FIELD = 'service'
+    TYPE_FIELD = 'type'
+    ID_FIELD = 'id'
+    VALUE_FIELD = 'value'
+
+    def __init__(self):
+        self._groups = []  # (service id, stream type)
+        self._offsets = [0]
+        self._ids = []
+        self._statuses = array('b')
+        self._columns = {name: array('d') for name in FleetHealth.COLUMNS}
+
+    @classmethod
+    def collect(cls, services):
+        health = cls()
+        for service in services:
+            health.add_service(service)
+        return health
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add_service(self, service):
+        by_type = {}
+        for stream in service.streams:
+            if isinstance(stream, HardwareStream):
+                by_type.setdefault(stream.get_type(), []).append(stream)
+
+        cpu = self._columns[FleetHealth.CPU]
+        rss = self._columns[FleetHealth.RSS]
+        idle_ratio = self._columns[FleetHealth.IDLE_RATIO]
+        sid = str(service.id)
+        for stream_type, streams in by_type.items():
+            for stream in streams:
+                status, cpu_value, rss_value, ratio = stream.get_runtime_summary()
+                self._ids.append(stream.id)
+                self._statuses.append(status)
+                cpu.append(cpu_value)
+                rss.append(rss_value)
+                idle_ratio.append(ratio)
+            self._groups.append((sid, stream_type))
+            self._offsets.append(len(self._ids))
+
+    # {service id: {'streams', 'cpu', 'rss'}}, by_type keys by (service id, stream type) instead
+    def get_totals(self, by_type=False) -> dict:
+        cpu = self._columns[FleetHealth.CPU]
+        rss = self._columns[FleetHealth.RSS]
+        totals = {}
+        for key, start, end in self._iter_groups(None):
+            key = key if by_type else key[0]
+            total = totals.setdefault(key, {FleetHealth.STREAMS_FIELD: 0, FleetHealth.CPU: 0.0, FleetHealth.RSS: 0.0})
+            total[FleetHealth.STREAMS_FIELD] += end - start
+            total[FleetHealth.CPU] += math.fsum(cpu[start:end])
+            total[FleetHealth.RSS] += math.fsum(rss[start:end])
+        return totals
+
+    # k largest of a column, over all services or one
+    def get_top(self, column: str, k=10, service_id=None) -> list:
+        values = self._columns[column]
+        candidates = []
+        for key, start, end in self._iter_groups(service_id):
+            top = heapq.nlargest(k, zip(values[start:end], range(start, end)))
+            candidates.extend((value, position, key) for value, position in top)
+
+        return [{FleetHealth.ID_FIELD: str(self._ids[position]), FleetHealth.SERVICE_FIELD: key[0],
+                 FleetHealth.TYPE_FIELD: key[1], FleetHealth.VALUE_FIELD: value}
+                for value, position, key in heapq.nlargest(k, candidates)]
+
+    # StreamStatus -> number of streams
+    def get_status_histogram(self, service_id=None) -> Counter:
+        histogram = Counter()
+        for _, start, end in self._iter_groups(service_id):
+            histogram.update(self._statuses[start:end])
+        return Counter({StreamStatus(status): count for status, count in histogram.items()})
+
+    # private
+    def _iter_groups(self, service_id):
+        for index, key in enumerate(self._groups):
+            if service_id is None or key[0] == service_id:
+                yield key, self._offsets[index], self._offsets[index + 1]
@@ -1,12 +1,18 @@
 from datetime import datetime
 from enum import IntEnum
+from hashlib import md5
 from urllib.parse import urlparse
+import json
 import os
 
-from mongoengine import StringField, IntField, EmbeddedDocumentField, Document, BooleanField, DateTimeField, FloatField
+from mongoengine import StringField, IntField, EmbeddedDocumentField, Document, BooleanField, DateTimeField, FloatField, \
+    ListField
 
 import app.common.constants as constants
+from app.common.changes.entry import ChannelChange
 from app.common.common_entries import Rational, Size, Logo, InputUrls, InputUrl, OutputUrls, OutputUrl
+from app.common.stream.history import RuntimeHistory
+from app.common.utils.playlist import PLAYLIST_HEADER, DEFAULT_CHUNK_SIZE, encode_chunks, PlaylistTemplate
 
 
 class ConfigFields:
@@ -120,6 +126,22 @@ class StreamLogLevel(IntEnum):
 
 
 class IStream(Document):
+    PLAYLIST_TYPES = frozenset([constants.StreamType.RELAY, constants.StreamType.VOD_RELAY,
+                                constants.StreamType.COD_RELAY, constants.StreamType.ENCODE,
+                                constants.StreamType.VOD_ENCODE, constants.StreamType.COD_ENCODE,
+                                constants.StreamType.PROXY, constants.StreamType.VOD_PROXY,
+                                constants.StreamType.TIMESHIFT_PLAYER, constants.StreamType.CATCHUP])
+    # fields the prerendered playlist parts are made from
+    RENDER_SOURCE_FIELDS = ('name', 'tvg_id', 'tvg_name', 'tvg_logo', 'group', 'output')
+    # ServiceSettings fields configs are made from
+    SETTINGS_CONFIG_FIELDS = ('feedback_directory', 'timeshifts_directory')
+    # fields used by generate_playlist() and generate_device_playlist()
+    PLAYLIST_FIELDS = ('render_version', 'playlist_extinf', 'playlist_fragment', 'device_links')
+    # to_dict() key -> stored field it is made from, None when no field is needed
+    DICT_SOURCE_FIELDS = {StreamFields.NAME: 'name', StreamFields.ID: None, StreamFields.TYPE: None,
+                          StreamFields.ICON: 'tvg_logo', StreamFields.PRICE: 'price', StreamFields.VISIBLE: 'visible',
+                          StreamFields.GROUP: 'group'}
+
     meta = {'collection': 'streams', 'allow_inheritance': True, 'auto_create_index': True}
 
     created_date = DateTimeField(default=datetime.now)  # for inner use
@@ -140,11 +162,55 @@ class IStream(Document):
     price = FloatField(default=0.0, min_value=constants.MIN_PRICE, max_value=constants.MAX_PRICE, required=True)
     visible = BooleanField(default=True, required=True)
 
-    output = EmbeddedDocumentField(OutputUrls, default=OutputUrls())  #
+    output = EmbeddedDocumentField(OutputUrls, default=OutputUrls)  #
+    # playlist the stream was imported from and is synced with, None for streams made by hand
+    m3u_source = StringField(default=None)
+
+    # prerendered playlist parts, refreshed by save()
+    render_version = IntField(default=0)
+    playlist_extinf = StringField(default=str())
+    playlist_fragment = StringField(default=str())
+    device_links = ListField(StringField(), default=[])  # sid/oid/file_name
+
+    _config = None
+    _config_json = None
+    _config_hash = None
+    _config_key = None
 
     def get_groups(self) -> list:
         return self.group.split(';')
 
+    # Streams of a ListField(ReferenceField(IStream)) loaded with one query and kept in the list order,
+    # refs can be raw values from _data, already loaded streams are reused
+    @classmethod
+    def load_by_refs(cls, refs, *fields) -> list:
+        loaded = {}
+        ids = []
+        for ref in refs:
+            if isinstance(ref, IStream):
+                loaded[ref.id] = ref
+            else:
+                ids.append(IStream.ref_id(ref))
+
+        if ids:
+            query = cls.objects(id__in=ids)
+            if fields:
+                query = query.only(*fields)
+            for stream in query:
+                loaded[stream.id] = stream
+
+        result = []
+        for ref in refs:
+            stream = loaded.get(IStream.ref_id(ref))
+            if stream is not None:
+                result.append(stream)
+        return result
+
+    @staticmethod
+    def ref_id(ref):
+        # DBRef and Document have id, a plain ObjectId is the id
+        return getattr(ref, 'id', ref)
+
     def to_dict(self) -> dict:
         return {StreamFields.NAME: self.name, StreamFields.ID: self.get_id(), StreamFields.TYPE: self.get_type(),
                 StreamFields.ICON: self.tvg_logo, StreamFields.PRICE: self.price, StreamFields.VISIBLE: self.visible,
@@ -163,7 +229,36 @@ class IStream(Document):
     def get_id(self) -> str:
         return str(self.id)
 
+    # make_config() built once and kept until the stream, its embedded documents or the settings values it is made
+    # from change, the dict is shared between callers and must not be modified
     def config(self) -> dict:
+        key = self._make_config_key()
+        if self._config is None or key != self._config_key:
+            self.invalidate_config()
+            self._config = self.make_config()
+            self._config_key = key
+        return self._config
+
+    # config() as compact JSON, ready to send to the streamer
+    def config_json(self) -> bytes:
+        config = self.config()
+        if self._config_json is None:
+            self._config_json = json.dumps(config, separators=(',', ':')).encode()
+        return self._config_json
+
+    # Digest of config_json(), equal digests mean the streamer needs no update
+    def config_hash(self) -> str:
+        config_json = self.config_json()
+        if self._config_hash is None:
+            self._config_hash = md5(config_json).hexdigest()
+        return self._config_hash
+
+    def invalidate_config(self):
+        self._config = None
+        self._config_json = None
+        self._config_hash = None
+
+    def make_config(self) -> dict:
         return {
             ConfigFields.ID_FIELD: self.get_id(),  # required
             ConfigFields.TYPE_FIELD: self.get_type(),  # required
@@ -177,55 +272,134 @@ class IStream(Document):
         return
 
     def generate_playlist(self, header=True) -> str:
-        result = '#EXTM3U\n' if header else ''
-        stream_type = self.get_type()
-        if stream_type == constants.StreamType.RELAY or stream_type == constants.StreamType.VOD_RELAY or stream_type == constants.StreamType.COD_RELAY or \
-                stream_type == constants.StreamType.ENCODE or stream_type == constants.StreamType.VOD_ENCODE or stream_type == constants.StreamType.COD_ENCODE or \
-                stream_type == constants.StreamType.PROXY or stream_type == constants.StreamType.VOD_PROXY or stream_type == constants.StreamType.VOD_ENCODE or \
-                stream_type == constants.StreamType.TIMESHIFT_PLAYER or stream_type == constants.StreamType.CATCHUP:
-            for out in self.output.urls:
-                result += '#EXTINF:-1 tvg-id="{0}" tvg-name="{1}" tvg-logo="{2}" group-title="{3}",{4}\n{5}\n'.format(
-                    self.tvg_id,
-                    self.tvg_name,
-                    self.tvg_logo,
-                    self.group,
-                    self.name,
-                    out.uri)
-
-        return result
+        return ''.join(self.iter_playlist(header))
 
     def generate_device_playlist(self, uid: str, passwd: str, did: str, lb_server_host_and_port: str,
                                  header=True) -> str:
-        result = '#EXTM3U\n' if header else ''
-        stream_type = self.get_type()
-        if stream_type == constants.StreamType.RELAY or stream_type == constants.StreamType.VOD_RELAY or stream_type == constants.StreamType.COD_RELAY or \
-                stream_type == constants.StreamType.ENCODE or stream_type == constants.StreamType.VOD_ENCODE or stream_type == constants.StreamType.COD_ENCODE or \
-                stream_type == constants.StreamType.PROXY or stream_type == constants.StreamType.VOD_PROXY or stream_type == constants.StreamType.VOD_ENCODE or \
-                stream_type == constants.StreamType.TIMESHIFT_PLAYER or stream_type == constants.StreamType.CATCHUP:
+        return ''.join(self.iter_device_playlist(uid, passwd, did, lb_server_host_and_port, header))
+
+    def iter_playlist(self, header=True):
+        if header:
+            yield PLAYLIST_HEADER
+        self._ensure_render()
+        if self.playlist_fragment:
+            yield self.playlist_fragment
+
+    def iter_device_playlist(self, uid: str, passwd: str, did: str, lb_server_host_and_port: str, header=True):
+        if header:
+            yield PLAYLIST_HEADER
+        self._ensure_render()
+        if self.device_links:
+            head = '{0}http://{1}/{2}/{3}/{4}/'.format(self.playlist_extinf, lb_server_host_and_port, uid, passwd, did)
+            for link in self.device_links:
+                yield head + link + '\n'
+
+    # Device playlist with signed urls instead of the password, see utils.url_signing
+    def iter_signed_device_playlist(self, uid: str, did: str, lb_server_host_and_port: str, signer, header=True):
+        if header:
+            yield PLAYLIST_HEADER
+        self._ensure_render()
+        for link in self.device_links:
+            yield self.playlist_extinf + signer.make_url(lb_server_host_and_port, uid, did, link) + '\n'
+
+    # Device playlist with the lb host and the device id left as template slots
+    def add_to_device_template(self, template, uid: str, passwd: str):
+        self._ensure_render()
+        credentials = '/{0}/{1}/'.format(uid, passwd)
+        for link in self.device_links:
+            template.append(self.playlist_extinf)
+            template.append('http://')
+            template.append_slot(PlaylistTemplate.LB_HOST)
+            template.append(credentials)
+            template.append_slot(PlaylistTemplate.DEVICE_ID)
+            template.append('/')
+            template.append(link)
+            template.append('\n')
+
+    def refresh_render(self):
+        extinf = '#EXTINF:-1 tvg-id="{0}" tvg-name="{1}" tvg-logo="{2}" group-title="{3}",{4}\n'.format(self.tvg_id,
+                                                                                                      self.tvg_name,
+                                                                                                      self.tvg_logo,
+                                                                                                      self.group,
+                                                                                                      self.name)
+        fragment = []
+        device_links = []
+        if self.get_type() in IStream.PLAYLIST_TYPES:
             for out in self.output.urls:
+                fragment.append('{0}{1}\n'.format(extinf, out.uri))
                 parsed_uri = urlparse(out.uri)
                 if parsed_uri.scheme == 'http' or parsed_uri.scheme == 'https':
                     file_name = os.path.basename(parsed_uri.path)
-                    url = 'http://{0}/{1}/{2}/{3}/{4}/{5}/{6}'.format(lb_server_host_and_port, uid, passwd, did,
-                                                                      self.id,
-                                                                      out.id, file_name)
-                    result += '#EXTINF:-1 tvg-id="{0}" tvg-name="{1}" tvg-logo="{2}" group-title="{3}",{4}\n{5}\n'.format(
-                        self.tvg_id,
-                        self.tvg_name,
-                        self.tvg_logo,
-                        self.group,
-                        self.name,
-                        url)
+                    device_links.append('{0}/{1}/{2}'.format(self.id, out.id, file_name))
 
-        return result
+        self.playlist_extinf = extinf
+        self.playlist_fragment = ''.join(fragment)
+        self.device_links = device_links
+        self.render_version += 1
+
+    def generate_playlist_chunks(self, header=True, chunk_size=DEFAULT_CHUNK_SIZE):
+        return encode_chunks(self.iter_playlist(header), chunk_size)
+
+    def generate_device_playlist_chunks(self, uid: str, passwd: str, did: str, lb_server_host_and_port: str,
+                                        header=True, chunk_size=DEFAULT_CHUNK_SIZE):
+        return encode_chunks(self.iter_device_playlist(uid, passwd, did, lb_server_host_and_port, header), chunk_size)
 
     def generate_input_playlist(self, header=True) -> str:
         raise NotImplementedError('subclasses must override generate_input_playlist()!')
 
     def save(self, *args, **kwargs):
+        modified = not self._created and bool(self._get_changed_fields())
         super(IStream, self).save(*args, **kwargs)
         self.fixup_output_urls()
-        return super(IStream, self).save(*args, **kwargs)
+        self.refresh_render()
+        result = super(IStream, self).save(*args, **kwargs)
+        if modified:
+            ChannelChange.record(ChannelChange.Action.MODIFIED, [self.id])
+        return result
+
+    def delete(self, *args, **kwargs):
+        # the PULL rules take the stream out of the lists, find who had it first
+        holders = ChannelChange.find_holders([self.id])
+        result = super(IStream, self).delete(*args, **kwargs)
+        ChannelChange.record_for_holders(ChannelChange.Action.REMOVED, holders)
+        return result
+
+    # private
+    def _mark_as_changed(self, key):
+        super(IStream, self)._mark_as_changed(key)
+        self.invalidate_config()
+
+    # the settings object may be shared and edited or come from anywhere, its values are compared on every use
+    def _make_config_key(self) -> tuple:
+        settings = self._settings
+        return tuple(getattr(settings, field, None) for field in IStream.SETTINGS_CONFIG_FIELDS)
+
+    def _on_embedded_changed(self):
+        self.invalidate_config()
+
+    def _ensure_render(self):
+        # built in memory and never saved: no change tracking tells when the parts got stale (giving the stream an
+        # id also clears _created), render on every use
+        changed_fields = getattr(self, '_changed_fields', None)
+        if changed_fields is None or self._created:
+            self.refresh_render()
+            return
+
+        # edited in memory and not saved yet
+        changed = any(field.split('.')[0] in IStream.RENDER_SOURCE_FIELDS for field in changed_fields)
+        if self.render_version and not changed:
+            return
+
+        if self.render_version or changed:
+            self.refresh_render()
+            return
+
+        # stored before the parts existed, render once and keep them
+        self.reload(*IStream.RENDER_SOURCE_FIELDS)
+        self.refresh_render()
+        IStream._get_collection().update_one({'_id': self.id, 'render_version': {'$in': [0, None]}}, {'$set': {
+            'render_version': self.render_version, 'playlist_extinf': self.playlist_extinf,
+            'playlist_fragment': self.playlist_fragment, 'device_links': self.device_links}})
 
 
 class ProxyStream(IStream):
@@ -249,7 +423,7 @@ class ProxyStream(IStream):
 class HardwareStream(IStream):
     log_level = IntField(default=StreamLogLevel.LOG_LEVEL_INFO, required=True)
 
-    input = EmbeddedDocumentField(InputUrls, default=InputUrls())
+    input = EmbeddedDocumentField(InputUrls, default=InputUrls)
     have_video = BooleanField(default=constants.DEFAULT_HAVE_VIDEO, required=True)
     have_audio = BooleanField(default=constants.DEFAULT_HAVE_AUDIO, required=True)
     audio_select = IntField(default=constants.INVALID_AUDIO_SELECT, required=True)
@@ -269,6 +443,11 @@ class HardwareStream(IStream):
     _start_time = 0
     _input_streams = str()
     _output_streams = str()
+    # stream.runtime.RuntimeTable shared by all workers, None keeps the runtime fields per process
+    runtime_table = None
+    _history = None
+    MIN_RUNTIME_INT = -2 ** 63
+    MAX_RUNTIME_INT = 2 ** 63 - 1
 
     def __init__(self, *args, **kwargs):
         super(HardwareStream, self).__init__(*args, **kwargs)
@@ -287,23 +466,16 @@ class HardwareStream(IStream):
         self._start_time = 0
         self._input_streams = str()
         self._output_streams = str()
+        self._publish_runtime_fields()
 
     def update_runtime_fields(self, params: dict):
         assert self.get_id() == params[StreamFields.ID]
         assert self.get_type() == params[StreamFields.TYPE]
-        self._status = StreamStatus(params[StreamFields.STATUS])
-        self._cpu = params[StreamFields.CPU]
-        self._timestamp = params[StreamFields.TIMESTAMP]
-        self._idle_time = params[StreamFields.IDLE_TIME]
-        self._rss = params[StreamFields.RSS]
-        self._loop_start_time = params[StreamFields.LOOP_START_TIME]
-        self._restarts = params[StreamFields.RESTARTS]
-        self._start_time = params[StreamFields.START_TIME]
-        self._input_streams = params[StreamFields.INPUT_STREAMS]
-        self._output_streams = params[StreamFields.OUTPUT_STREAMS]
+        self._apply_runtime_fields(params)
 
     def to_dict(self) -> dict:
         front = super(HardwareStream, self).to_dict()
+        self._load_runtime_fields()
         front[StreamFields.STATUS] = self._status
         front[StreamFields.CPU] = self._cpu
         front[StreamFields.TIMESTAMP] = self._timestamp
@@ -315,13 +487,29 @@ class HardwareStream(IStream):
         front[StreamFields.INPUT_STREAMS] = self._input_streams
         front[StreamFields.OUTPUT_STREAMS] = self._output_streams
         # runtime
-        work_time = self._timestamp - self._start_time
-        quality = 100 - (100 * self._idle_time / work_time) if work_time else 100
-        front[StreamFields.QUALITY] = quality
+        front[StreamFields.QUALITY] = self.get_quality()
         return front
 
-    def config(self) -> dict:
-        conf = super(HardwareStream, self).config()
+    def get_quality(self):
+        work_time = self._timestamp - self._start_time
+        return 100 - (100 * self._idle_time / work_time) if work_time else 100
+
+    # (status, cpu, rss, idle ratio) for fleet aggregation without building to_dict()
+    def get_runtime_summary(self) -> tuple:
+        self._load_runtime_fields()
+        work_time = self._timestamp - self._start_time
+        return self._status, self._cpu, self._rss, self._idle_time / work_time if work_time else 0.0
+
+    # Samples of the statuses this process received, None before the first one
+    def get_runtime_history(self) -> RuntimeHistory:
+        return self._history
+
+    # Windowed mean/p95 and restart rate, window in seconds
+    def get_runtime_stats(self, window=None):
+        return self._history.to_dict(window) if self._history is not None else None
+
+    def make_config(self) -> dict:
+        conf = super(HardwareStream, self).make_config()
         conf[ConfigFields.FEEDBACK_DIR_FIELD] = self.generate_feedback_dir()
         conf[ConfigFields.LOG_LEVEL_FIELD] = self.get_log_level()
         conf[ConfigFields.AUTO_EXIT_TIME_FIELD] = self.get_auto_exit_time()
@@ -410,6 +598,54 @@ class HardwareStream(IStream):
         return stream
 
     # private
+    def _apply_runtime_fields(self, params: dict):
+        # coerced into locals first, a bad value raises KeyError, ValueError or TypeError before anything is set
+        status = StreamStatus(params[StreamFields.STATUS])
+        cpu = float(params[StreamFields.CPU])
+        timestamp, idle_time, rss, loop_start_time, restarts, start_time = (
+            HardwareStream._to_runtime_int(params[field])
+            for field in (StreamFields.TIMESTAMP, StreamFields.IDLE_TIME, StreamFields.RSS,
+                          StreamFields.LOOP_START_TIME, StreamFields.RESTARTS, StreamFields.START_TIME))
+        input_streams = params[StreamFields.INPUT_STREAMS]
+        output_streams = params[StreamFields.OUTPUT_STREAMS]
+
+        # not document fields, set in one go without BaseDocument.__setattr__
+        self.__dict__.update(_status=status, _cpu=cpu, _timestamp=timestamp, _idle_time=idle_time, _rss=rss,
+                             _loop_start_time=loop_start_time, _restarts=restarts, _start_time=start_time,
+                             _input_streams=input_streams, _output_streams=output_streams)
+        self._publish_runtime_fields()
+        if self._history is None:
+            self._history = RuntimeHistory()
+        self._history.append(cpu, rss, idle_time, restarts, self.get_quality())
+
+    # int that fits the 64-bit columns of the runtime table
+    @staticmethod
+    def _to_runtime_int(value) -> int:
+        result = int(value)
+        if not HardwareStream.MIN_RUNTIME_INT <= result <= HardwareStream.MAX_RUNTIME_INT:
+            raise ValueError('Runtime value out of range: {0}'.format(value))
+        return result
+
+    # numeric runtime fields go to the shared table, input/output streams stay in this process
+    # only the writer publishes, runtime fields set in reader processes stay local
+    def _publish_runtime_fields(self):
+        table = HardwareStream.runtime_table
+        if table is not None and table.writable and self.id is not None:
+            table.write(self.id.binary, (self._status, self._cpu, self._timestamp, self._idle_time, self._rss,
+                                         self._loop_start_time, self._restarts, self._start_time))
+
+    def _load_runtime_fields(self):
+        table = HardwareStream.runtime_table
+        if table is None or self.id is None:
+            return
+
+        values = table.read(self.id.binary)
+        if values is not None:
+            status, cpu, timestamp, idle_time, rss, loop_start_time, restarts, start_time = values
+            self.__dict__.update(_status=StreamStatus(status), _cpu=cpu, _timestamp=timestamp, _idle_time=idle_time,
+                                 _rss=rss, _loop_start_time=loop_start_time, _restarts=restarts,
+                                 _start_time=start_time)
+
     def _generate_http_root_dir(self, oid: int):
         return '{0}/{1}/{2}/{3}'.format(self._settings.hls_directory, self.get_type(), self.get_id(), oid)
 
@@ -463,8 +699,8 @@ class RelayStream(HardwareStream):
     def get_type(self):
         return constants.StreamType.RELAY
 
-    def config(self) -> dict:
-        conf = super(RelayStream, self).config()
+    def make_config(self) -> dict:
+        conf = super(RelayStream, self).make_config()
         conf[ConfigFields.VIDEO_PARSER_FIELD] = self.get_video_parser()
         conf[ConfigFields.AUDIO_PARSER_FIELD] = self.get_audio_parser()
         return conf
@@ -499,11 +735,11 @@ class EncodeStream(HardwareStream):
     video_codec = StringField(default=constants.DEFAULT_VIDEO_CODEC, required=True)
     audio_codec = StringField(default=constants.DEFAULT_AUDIO_CODEC, required=True)
     audio_channels_count = IntField(default=constants.INVALID_AUDIO_CHANNELS_COUNT, required=True)
-    size = EmbeddedDocumentField(Size, default=Size())
+    size = EmbeddedDocumentField(Size, default=Size)
     video_bit_rate = IntField(default=constants.INVALID_VIDEO_BIT_RATE, required=True)
     audio_bit_rate = IntField(default=constants.INVALID_AUDIO_BIT_RATE, required=True)
-    logo = EmbeddedDocumentField(Logo, default=Logo())
-    aspect_ratio = EmbeddedDocumentField(Rational, default=Rational())
+    logo = EmbeddedDocumentField(Logo, default=Logo)
+    aspect_ratio = EmbeddedDocumentField(Rational, default=Rational)
 
     def get_type(self):
         return constants.StreamType.ENCODE
@@ -514,8 +750,8 @@ class EncodeStream(HardwareStream):
     def get_relay_audio(self):
         return self.relay_audio
 
-    def config(self) -> dict:
-        conf = super(EncodeStream, self).config()
+    def make_config(self) -> dict:
+        conf = super(EncodeStream, self).make_config()
         conf[ConfigFields.RELAY_VIDEO_FIELD] = self.get_relay_video()
         conf[ConfigFields.RELAY_AUDIO_FIELD] = self.get_relay_audio()
         conf[ConfigFields.DEINTERLACE_FIELD] = self.get_deinterlace()
@@ -590,8 +826,8 @@ class TimeshiftRecorderStream(RelayStream):
     def get_type(self):
         return constants.StreamType.TIMESHIFT_RECORDER
 
-    def config(self) -> dict:
-        conf = super(TimeshiftRecorderStream, self).config()
+    def make_config(self) -> dict:
+        conf = super(TimeshiftRecorderStream, self).make_config()
         conf[ConfigFields.TIMESHIFT_CHUNK_DURATION] = self.get_timeshift_chunk_duration()
         conf[ConfigFields.TIMESHIFT_DIR] = self.generate_timeshift_dir()
         conf[ConfigFields.TIMESHIFT_CHUNK_LIFE_TIME] = self.timeshift_chunk_life_time
@@ -642,8 +878,8 @@ class TimeshiftPlayerStream(RelayStream):
     def get_type(self):
         return constants.StreamType.TIMESHIFT_PLAYER
 
-    def config(self) -> dict:
-        conf = super(TimeshiftPlayerStream, self).config()
+    def make_config(self) -> dict:
+        conf = super(TimeshiftPlayerStream, self).make_config()
         conf[ConfigFields.TIMESHIFT_DIR] = self.timeshift_dir
         conf[ConfigFields.TIMESHIFT_DELAY] = self.timeshift_delay
         return conf
@@ -664,8 +900,8 @@ class TestLifeStream(RelayStream):
     def get_type(self):
         return constants.StreamType.TEST_LIFE
 
-    def config(self) -> dict:
-        conf = super(TestLifeStream, self).config()
+    def make_config(self) -> dict:
+        conf = super(TestLifeStream, self).make_config()
         return conf
 
     def fixup_output_urls(self):
@@ -688,8 +924,8 @@ class CodRelayStream(RelayStream):
     def get_type(self):
         return constants.StreamType.COD_RELAY
 
-    def config(self) -> dict:
-        conf = super(CodRelayStream, self).config()
+    def make_config(self) -> dict:
+        conf = super(CodRelayStream, self).make_config()
         return conf
 
     def fixup_output_urls(self):
@@ -711,8 +947,8 @@ class CodEncodeStream(EncodeStream):
     def get_type(self):
         return constants.StreamType.COD_ENCODE
 
-    def config(self) -> dict:
-        conf = super(CodEncodeStream, self).config()
+    def make_config(self) -> dict:
+        conf = super(CodEncodeStream, self).make_config()
         return conf
 
     def fixup_output_urls(self):
@@ -777,8 +1013,8 @@ class VodRelayStream(RelayStream, VodBasedStream):
         base = VodBasedStream.to_dict(self)
         return {**front, **base}
 
-    def config(self) -> dict:
-        conf = RelayStream.config(self)
+    def make_config(self) -> dict:
+        conf = RelayStream.make_config(self)
         conf[ConfigFields.VODS_CLEANUP_TS] = True
         return conf
 
@@ -807,8 +1043,8 @@ class VodEncodeStream(EncodeStream, VodBasedStream):
         base = VodBasedStream.to_dict(self)
         return {**front, **base}
 
-    def config(self) -> dict:
-        conf = EncodeStream.config(self)
+    def make_config(self) -> dict:
+        conf = EncodeStream.make_config(self)
         conf[ConfigFields.VODS_CLEANUP_TS] = True
         return conf
 
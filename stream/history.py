@@ -0,0 +1,97 @@
+import math
+import time
+from array import array
+
+
+# Last capacity runtime samples of a stream in fixed-size ring buffers, for trends and sparklines
+# Sample times are seconds of arrival, windows are in seconds back from the newest sample
+class RuntimeHistory:
+    DEFAULT_CAPACITY = 720  # an hour of statuses every 5 seconds
+    CPU = 'cpu'
+    RSS = 'rss'
+    IDLE_TIME = 'idle_time'
+    RESTARTS = 'restarts'
+    QUALITY = 'quality'
+    SERIES = (CPU, RSS, IDLE_TIME, RESTARTS, QUALITY)
+    MEAN_FIELD = 'mean'
+    P95_FIELD = 'p95'
+    RESTART_RATE_FIELD = 'restarts_per_hour'
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self._times = array('d', bytes(capacity * 8))
+        # float32 is plenty for graphs and halves the memory
+        self._series = {name: array('f', bytes(capacity * 4)) for name in RuntimeHistory.SERIES}
+        self._columns = tuple(self._series[name] for name in RuntimeHistory.SERIES)
+        self._next = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, cpu, rss, idle_time, restarts, quality, timestamp=None):
+        position = self._next
+        self._times[position] = time.time() if timestamp is None else timestamp
+        for values, value in zip(self._columns, (cpu, rss, idle_time, restarts, quality)):
+            values[position] = value
+        position += 1
+        self._next = position if position < self.capacity else 0
+        if self._size < self.capacity:
+            self._size += 1
+
+    # Oldest first
+    def get_times(self, window=None) -> list:
+        return self._select(self._times, window)
+
+    def get_values(self, name: str, window=None) -> list:
+        return self._select(self._series[name], window)
+
+    def get_mean(self, name: str, window=None):
+        values = self.get_values(name, window)
+        return math.fsum(values) / len(values) if values else None
+
+    # Nearest-rank percentile
+    def get_percentile(self, name: str, percent: float, window=None):
+        values = sorted(self.get_values(name, window))
+        if not values:
+            return None
+        return values[max(math.ceil(percent / 100 * len(values)) - 1, 0)]
+
+    # Restarts counter increase per hour, a counter that went down was reset and counts from zero
+    def get_restart_rate(self, window=None) -> float:
+        times = self.get_times(window)
+        if len(times) < 2 or times[-1] <= times[0]:
+            return 0.0
+
+        restarts = self.get_values(RuntimeHistory.RESTARTS, window)
+        increase = 0.0
+        for previous, current in zip(restarts, restarts[1:]):
+            increase += current - previous if current >= previous else current
+        return increase * 3600 / (times[-1] - times[0])
+
+    def to_dict(self, window=None) -> dict:
+        result = {}
+        for name in (RuntimeHistory.CPU, RuntimeHistory.RSS, RuntimeHistory.IDLE_TIME, RuntimeHistory.QUALITY):
+            result[name] = {RuntimeHistory.MEAN_FIELD: self.get_mean(name, window),
+                            RuntimeHistory.P95_FIELD: self.get_percentile(name, 95, window)}
+        result[RuntimeHistory.RESTART_RATE_FIELD] = self.get_restart_rate(window)
+        return result
+
+    # private
+    def _count(self, window) -> int:
+        if window is None or not self._size:
+            return self._size
+
+        newest = (self._next - 1) % self.capacity
+        since = self._times[newest] - window
+        count = 0
+        while count < self._size and self._times[(newest - count) % self.capacity] >= since:
+            count += 1
+        return count
+
+    def _select(self, data: array, window) -> list:
+        count = self._count(window)
+        start = (self._next - count) % self.capacity
+        if start + count <= self.capacity:
+            return data[start:start + count].tolist()
+        return data[start:].tolist() + data[:start + count - self.capacity].tolist()
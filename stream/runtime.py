@@ -0,0 +1,147 @@
+import struct
+import time
+from multiprocessing import shared_memory
+
+
+# Runtime fields of streams in shared memory, one column per field and one slot per stream
+#
+# Single writer: the process receiving streamer statuses takes slots and writes them, any number of processes
+# read. Only the table opened as the writer (create() by default, attach(writable=True)) may write, the others
+# are readers. Each slot has a sequence number that is odd while the slot is written, readers retry until they
+# read the same even number before and after the values (seqlock), so a read never mixes two statuses.
+class RuntimeTable:
+    MAGIC = 0x31425452
+    HEADER = struct.Struct('<IIQ')  # magic, capacity, used slots
+    KEY_SIZE = 12  # ObjectId binary
+    COLUMN_ITEM_SIZE = 8
+    # field -> typecode, in layout order after the sequence numbers
+    FIELDS = (('status', 'q'), ('cpu', 'd'), ('timestamp', 'q'), ('idle_time', 'q'), ('rss', 'q'),
+              ('loop_start_time', 'q'), ('restarts', 'q'), ('start_time', 'q'))
+    READ_SPINS = 100
+    # a slot still odd after this many tries was left by a writer that died mid-write
+    MAX_READ_TRIES = 10000
+
+    def __init__(self, memory: shared_memory.SharedMemory, writable=False):
+        self._memory = memory
+        self.writable = writable
+        magic, self.capacity, _ = RuntimeTable.HEADER.unpack_from(memory.buf)
+        if magic != RuntimeTable.MAGIC:
+            raise ValueError('Invalid runtime table: {0}'.format(memory.name))
+
+        self._used = memory.buf[8:16].cast('Q')
+        offset = RuntimeTable.HEADER.size
+        self._keys = memory.buf[offset:offset + self.capacity * RuntimeTable.KEY_SIZE]
+        offset += RuntimeTable._align(self.capacity * RuntimeTable.KEY_SIZE)
+        self._seq = self._column(offset, 'Q')
+        offset += self.capacity * RuntimeTable.COLUMN_ITEM_SIZE
+        self._columns = []
+        for _, typecode in RuntimeTable.FIELDS:
+            self._columns.append(self._column(offset, typecode))
+            offset += self.capacity * RuntimeTable.COLUMN_ITEM_SIZE
+        self._converters = [float if typecode == 'd' else int for _, typecode in RuntimeTable.FIELDS]
+        self._slots = {}
+
+    @classmethod
+    def create(cls, name: str, capacity: int, writable=True):
+        memory = shared_memory.SharedMemory(name=name, create=True, size=cls.get_size(capacity))
+        cls.HEADER.pack_into(memory.buf, 0, cls.MAGIC, capacity, 0)
+        return cls(memory, writable)
+
+    # Readers by default, writable=True for the writer when another process created the table
+    @classmethod
+    def attach(cls, name: str, writable=False):
+        return cls(shared_memory.SharedMemory(name=name), writable)
+
+    @classmethod
+    def get_size(cls, capacity: int) -> int:
+        return cls.HEADER.size + cls._align(capacity * cls.KEY_SIZE) + \
+               (len(cls.FIELDS) + 1) * capacity * cls.COLUMN_ITEM_SIZE
+
+    @property
+    def name(self) -> str:
+        return self._memory.name
+
+    def __len__(self):
+        return self._used[0]
+
+    # Writer only, False when the table is full
+    def write(self, key: bytes, values) -> bool:
+        if not self.writable:
+            raise ValueError('Runtime table opened for reading: {0}'.format(self._memory.name))
+
+        slot = self._find_slot(key)
+        if slot < 0:
+            slot = self._add_slot(key)
+            if slot < 0:
+                return False
+
+        values = [convert(value) for convert, value in zip(self._converters, values)]
+        seq = self._seq
+        seq[slot] += 1
+        for column, value in zip(self._columns, values):
+            column[slot] = value
+        seq[slot] += 1
+        return True
+
+    # Values in FIELDS order, None for a stream without a slot or one that stays mid-write
+    def read(self, key: bytes):
+        slot = self._find_slot(key)
+        if slot < 0:
+            return None
+
+        seq = self._seq
+        for tries in range(1, RuntimeTable.MAX_READ_TRIES + 1):
+            before = seq[slot]
+            if not before & 1:
+                values = tuple(column[slot] for column in self._columns)
+                if seq[slot] == before:
+                    return values
+            if tries % RuntimeTable.READ_SPINS == 0:
+                time.sleep(0)
+        return None
+
+    def close(self):
+        self._release()
+        self._memory.close()
+
+    # Creator only, after every process closed the table
+    def unlink(self):
+        self._memory.unlink()
+
+    # private
+    @staticmethod
+    def _align(size: int) -> int:
+        return (size + RuntimeTable.COLUMN_ITEM_SIZE - 1) // RuntimeTable.COLUMN_ITEM_SIZE * \
+               RuntimeTable.COLUMN_ITEM_SIZE
+
+    def _column(self, offset: int, typecode: str) -> memoryview:
+        return self._memory.buf[offset:offset + self.capacity * RuntimeTable.COLUMN_ITEM_SIZE].cast(typecode)
+
+    def _find_slot(self, key: bytes) -> int:
+        slot = self._slots.get(key)
+        if slot is not None:
+            return slot
+
+        # slots taken by the writer since the last lookup
+        used = self._used[0]
+        for known in range(len(self._slots), used):
+            offset = known * RuntimeTable.KEY_SIZE
+            self._slots[bytes(self._keys[offset:offset + RuntimeTable.KEY_SIZE])] = known
+        return self._slots.get(key, -1)
+
+    def _add_slot(self, key: bytes) -> int:
+        slot = self._used[0]
+        if slot >= self.capacity:
+            return -1
+
+        # the key is written before the slot is counted, readers never see a slot without its key
+        offset = slot * RuntimeTable.KEY_SIZE
+        self._keys[offset:offset + RuntimeTable.KEY_SIZE] = key
+        self._used[0] = slot + 1
+        self._slots[key] = slot
+        return slot
+
+    def _release(self):
+        for view in [self._used, self._keys, self._seq] + self._columns:
+            view.release()
+        self._columns = []
@@ -1,3 +1,4 @@
+import re
 from datetime import datetime
 from hashlib import md5
 from bson.objectid import ObjectId
@@ -8,7 +9,12 @@ from mongoengine import Document, EmbeddedDocument, StringField, DateTimeField,
 
 from app.common.service.entry import ServiceSettings
 from app.common.stream.entry import IStream
+from app.common.utils.playlist import DEFAULT_CHUNK_SIZE, PLAYLIST_HEADER, PLAYLIST_ENCODINGS, encode_chunks, \
+    PlaylistCache, CachedPlaylist, PlaylistTemplate
+from app.common.utils.list_index import ListIndex
+from app.common.utils.playlist_store import PlaylistStore
 import app.common.constants as constants
+from app.common.changes.entry import ChannelChange
 
 
 class Device(EmbeddedDocument):
@@ -77,6 +83,18 @@ class Subscriber(Document):
 
     SUBSCRIBER_HASH_LENGTH = 32
 
+    PLAYLIST_TEMPLATE_KEY = 'template'
+    PLAYLIST_STORE_KEY_TEMPLATE = 'subscriber_{0}_{1}_{2}'
+    DEFAULT_CHANNELS_PAGE_SIZE = 100
+    CHANNELS_CURSOR_SEPARATOR = '.'
+    CHANGES_SEQ_FIELD = 'seq'
+    CHANGES_SNAPSHOT_FIELD = 'snapshot'
+    CHANGES_CHANNELS_FIELD = 'channels'
+    CHANGES_REMOVED_FIELD = 'removed'
+    # fields the device playlist is made from besides the streams themselves
+    PLAYLIST_SOURCE_FIELDS = ('streams', 'own_streams', 'password')
+    playlist_cache = PlaylistCache()
+
     meta = {'allow_inheritance': True, 'collection': 'subscribers', 'auto_create_index': False}
 
     email = StringField(max_length=64, required=True)
@@ -91,6 +109,13 @@ class Subscriber(Document):
     devices = ListField(EmbeddedDocumentField(Device), default=[])
     streams = ListField(ReferenceField(IStream, reverse_delete_rule=PULL), default=[])
     own_streams = ListField(ReferenceField(IStream, reverse_delete_rule=PULL), default=[])
+    # bumped with every change of the playlist, see ChannelChange
+    playlist_seq = IntField(default=0)
+
+    def __init__(self, *args, **kwargs):
+        super(Subscriber, self).__init__(*args, **kwargs)
+        self._devices_index = ListIndex(lambda device: str(device.id))
+        self._own_streams_index = ListIndex(lambda ref: str(IStream.ref_id(ref)))
 
     def add_server(self, server):
         self.servers.append(server)
@@ -98,60 +123,244 @@ class Subscriber(Document):
 
     def add_device(self, device: Device):
         self.devices.append(device)
+        self._devices_index.invalidate()
         self.save()
 
     def remove_device(self, sid: str):
-        for device in self.devices:
-            if str(device.id) == sid:
-                self.devices.remove(device)
-                break
+        position = self._devices_index.find(self.devices, sid)
+        if position >= 0:
+            del self.devices[position]
+            self._devices_index.invalidate()
         self.save()
 
     def find_device(self, sid: str):
-        for device in self.devices:
-            if str(device.id) == sid:
-                return device
-        return None
+        return self._devices_index.get(self.devices, sid)
 
     def generate_playlist(self, did: str, lb_server_host_and_port: str) -> str:
-        result = '#EXTM3U\n'
+        return ''.join(self.iter_playlist(did, lb_server_host_and_port))
+
+    def iter_playlist(self, did: str, lb_server_host_and_port: str):
+        yield PLAYLIST_HEADER
         sid = str(self.id)
-        for stream in self.streams:
-            result += stream.generate_device_playlist(sid, self.password, did, lb_server_host_and_port, False)
+        for stream in self.get_streams(*IStream.PLAYLIST_FIELDS):
+            yield from stream.iter_device_playlist(sid, self.password, did, lb_server_host_and_port, False)
 
-        for own in self.own_streams:
-            result += own.generate_playlist(False)
+        for own in self.get_own_streams(*IStream.PLAYLIST_FIELDS):
+            yield from own.iter_playlist(False)
 
-        return result
+    # Playlist with urls signed by signer (ServiceSettings.make_url_signer), no password in the links
+    def generate_signed_playlist(self, did: str, lb_server_host_and_port: str, signer) -> str:
+        return ''.join(self.iter_signed_playlist(did, lb_server_host_and_port, signer))
+
+    def iter_signed_playlist(self, did: str, lb_server_host_and_port: str, signer):
+        yield PLAYLIST_HEADER
+        sid = str(self.id)
+        for stream in self.get_streams(*IStream.PLAYLIST_FIELDS):
+            yield from stream.iter_signed_device_playlist(sid, did, lb_server_host_and_port, signer, False)
+
+        for own in self.get_own_streams(*IStream.PLAYLIST_FIELDS):
+            yield from own.iter_playlist(False)
+
+    # Encoded playlist for streaming responses
+    def generate_playlist_chunks(self, did: str, lb_server_host_and_port: str, chunk_size=DEFAULT_CHUNK_SIZE):
+        return encode_chunks(self.iter_playlist(did, lb_server_host_and_port), chunk_size)
+
+    # Device playlist from the cache, rendered again only when playlist_version() changed
+    def get_cached_playlist(self, did: str, lb_server_host_and_port: str) -> CachedPlaylist:
+        sid = str(self.id)
+        key = (did, lb_server_host_and_port)
+        version = self.playlist_version()
+        cached = Subscriber.playlist_cache.get(sid, key, version)
+        if cached is None:
+            # devices of one subscriber share the template, only the slots differ
+            template = Subscriber.playlist_cache.get(sid, Subscriber.PLAYLIST_TEMPLATE_KEY, version)
+            if template is None:
+                template = self.compile_playlist_template(version)
+                Subscriber.playlist_cache.put(sid, Subscriber.PLAYLIST_TEMPLATE_KEY, template)
+            content = template.render(did=did, lb_server_host_and_port=lb_server_host_and_port)
+            cached = Subscriber.playlist_cache.put(sid, key, CachedPlaylist(version, content))
+        return cached
+
+    # Device independent playlist, render(did=..., lb_server_host_and_port=...) needs no database access
+    def compile_playlist_template(self, version=None) -> PlaylistTemplate:
+        template = PlaylistTemplate(version if version is not None else self.playlist_version())
+        template.append(PLAYLIST_HEADER)
+        sid = str(self.id)
+        for stream in self.get_streams(*IStream.PLAYLIST_FIELDS):
+            stream.add_to_device_template(template, sid, self.password)
+
+        for own in self.get_own_streams(*IStream.PLAYLIST_FIELDS):
+            for fragment in own.iter_playlist(False):
+                template.append(fragment)
+        return template
+
+    # the content depends on the load balancer host as well, like the get_cached_playlist() key
+    def get_playlist_store_key(self, did: str, lb_server_host_and_port: str) -> str:
+        return Subscriber.PLAYLIST_STORE_KEY_TEMPLATE.format(self.id, did, lb_server_host_and_port)
+
+    # Device playlist into a shared store (see ServiceSettings.get_playlist_store), returns the etag
+    # compress also stores gzip/zstd forms, see StoredPlaylist.negotiate
+    def publish_playlist(self, store: PlaylistStore, did: str, lb_server_host_and_port: str, compress=False) -> str:
+        key = self.get_playlist_store_key(did, lb_server_host_and_port)
+        cached = self.get_cached_playlist(did, lb_server_host_and_port)
+        stored = store.get(key)
+        if stored is not None and stored.version == cached.version and stored.etag == cached.etag and (
+                not compress or all(encoding in stored.sections for encoding in PLAYLIST_ENCODINGS)):
+            return stored.etag
+
+        encoded = cached.compress_all() if compress else {}
+        return store.publish(key, cached.content, cached.version, **encoded)
+
+    def get_published_playlist(self, store: PlaylistStore, did: str, lb_server_host_and_port: str):
+        return store.get(self.get_playlist_store_key(did, lb_server_host_and_port))
+
+    # (encoding, bytes) of the cached device playlist for the client Accept-Encoding, compressed once per version
+    def get_encoded_playlist(self, did: str, lb_server_host_and_port: str, accept_encoding: str):
+        return self.get_cached_playlist(did, lb_server_host_and_port).negotiate(accept_encoding)
+
+    # For If-None-Match, False when etag still matches the device playlist, answered from the cache without
+    # rendering; a playlist not cached in this process at the current version counts as changed
+    def is_playlist_changed(self, did: str, lb_server_host_and_port: str, etag: str) -> bool:
+        cached = Subscriber.playlist_cache.get(str(self.id), (did, lb_server_host_and_port), self.playlist_version())
+        return cached is None or cached.etag != etag
+
+    # Changes with the stream lists, the password and every save() of a listed stream, one read of playlist_seq
+    def playlist_version(self) -> str:
+        doc = Subscriber._get_collection().find_one({'_id': self.id}, {'_id': False, 'playlist_seq': True})
+        seq = doc.get('playlist_seq', 0) if doc else 0
+        h = md5(self.password.encode())
+        h.update('|{0}'.format(seq).encode())
+        return h.hexdigest()
+
+    # Streams loaded with one query, fields limits the loaded fields
+    def get_streams(self, *fields) -> list:
+        return IStream.load_by_refs(self._data['streams'], *fields)
+
+    def get_own_streams(self, *fields) -> list:
+        return IStream.load_by_refs(self._data['own_streams'], *fields)
+
+    # One page of to_dict() records in playlist order and the cursor of the next page, None after the last one
+    # group, stream_type (one or several) and visible filter, fields limits the record keys and loaded fields
+    # Only the ids of the page are sent to Mongo, so a page costs the same for any number of channels
+    def list_channels(self, cursor=None, limit=DEFAULT_CHANNELS_PAGE_SIZE, group=None, stream_type=None,
+                      visible=None, fields=None):
+        refs = self._data['streams'] + self._data['own_streams']
+        position = self._find_channels_cursor(refs, cursor)
+        query = Subscriber._make_channels_query(group, stream_type, visible)
+        projection = Subscriber._make_channels_projection(fields)
+        # ids of the page in list order, found with _id-only queries over slices that double each pass so a
+        # selective filter takes log(n) queries instead of one per limit channels
+        page = []
+        size = limit
+        while position < len(refs) and len(page) < limit:
+            chunk = refs[position:position + size]
+            query['_id'] = {'$in': [IStream.ref_id(ref) for ref in chunk]}
+            matching = {doc['_id'] for doc in IStream._get_collection().find(query, {'_id': True})}
+            for ref in chunk:
+                position += 1
+                sid = IStream.ref_id(ref)
+                if sid in matching:
+                    page.append(sid)
+                    if len(page) == limit:
+                        break
+            size *= 2
+
+        streams = IStream.objects(id__in=page)
+        if projection is not None:
+            streams = streams.only(*projection)
+        loaded = {stream.id: stream for stream in streams}
+        channels = []
+        for sid in page:
+            stream = loaded.get(sid)
+            if stream is not None:
+                record = stream.to_dict()
+                channels.append({key: record[key] for key in fields} if fields else record)
+
+        if position >= len(refs):
+            return channels, None
+        return channels, Subscriber.CHANNELS_CURSOR_SEPARATOR.join((str(position),
+                                                                    str(IStream.ref_id(refs[position - 1]))))
 
     def add_official_stream(self, stream: IStream):
         self.streams.append(stream)
         self.save()
+        Subscriber.playlist_cache.invalidate(str(self.id))
+        ChannelChange.record(ChannelChange.Action.ADDED, [stream.id], self.id)
 
     def add_own_stream(self, stream: IStream):
         self.own_streams.append(stream)
+        self._own_streams_index.invalidate()
         self.save()
+        Subscriber.playlist_cache.invalidate(str(self.id))
+        ChannelChange.record(ChannelChange.Action.ADDED, [stream.id], self.id)
 
     def remove_own_stream(self, sid: str):
-        for stream in self.own_streams:
-            if str(stream.id) == sid:
-                self.own_streams.remove(stream)
-                stream.delete()
-                break
+        stream = self.find_own_stream(sid)
+        if stream is not None:
+            self.own_streams = [ref for ref in self._data['own_streams'] if IStream.ref_id(ref) != stream.id]
+            self._own_streams_index.invalidate()
+            stream.delete()
         self.save()
+        Subscriber.playlist_cache.invalidate(str(self.id))
+        if stream is not None:
+            ChannelChange.record(ChannelChange.Action.REMOVED, [stream.id], self.id)
+
+    # Channel list changes after seq as {'seq', 'snapshot', 'channels', 'removed'}: channels are to_dict() records
+    # of added and modified channels, removed their ids. A snapshot (all channels, nothing removed) is returned
+    # when seq is None or older than the compacted log, or when the delta would not be smaller.
+    def changes_since(self, seq) -> dict:
+        until = ChannelChange.settled_seq()
+        refs = self._data['streams'] + self._data['own_streams']
+        if seq is None or seq < ChannelChange.compacted_seq():
+            return self._make_channels_snapshot(until)
+        if seq >= until:
+            return Subscriber._make_channels_delta(seq, [], [])
+
+        # stream id -> True when only the stream itself was modified, ordered by the last change
+        listed_ids = set(map(IStream.ref_id, refs))
+        touched = {}
+        own = set()  # touched by records of this subscriber
+        for change in ChannelChange.find_since(seq, until, self.id, listed_ids):
+            sid = change['stream']
+            only_modified = touched.pop(sid, True) and change['subscriber'] is None and \
+                change['action'] == ChannelChange.Action.MODIFIED
+            touched[sid] = only_modified
+            if change['subscriber'] is not None:
+                own.add(sid)
+
+        # the current lists decide, whatever happened in between
+        listed = {sid for sid in touched if sid in listed_ids}
+        # removals of streams this subscriber never had do not make the delta larger for the client
+        if len(listed | own) >= len(refs):
+            return self._make_channels_snapshot(until)
+
+        loaded = {stream.id: stream for stream in IStream.load_by_refs([sid for sid in touched if sid in listed])}
+        channels = []
+        removed = []
+        for sid, only_modified in touched.items():
+            stream = loaded.get(sid)
+            if stream is not None:
+                channels.append(stream.to_dict())
+            elif not only_modified or sid in listed:
+                removed.append(str(sid))
+        return Subscriber._make_channels_delta(until, channels, removed)
 
     def find_own_stream(self, sid: str):
-        for stream in self.own_streams:
-            if str(stream.id) == sid:
-                return stream
-        return None
+        refs = self._data['own_streams']
+        position = self._own_streams_index.find(refs, sid)
+        if position < 0:
+            return None
+        streams = IStream.load_by_refs([refs[position]])
+        return streams[0] if streams else None
 
     def remove_all_own_streams(self):
         for stream in self.own_streams:
             self.own_streams.remove(stream)
             stream.delete()
         self.own_streams = []
+        self._own_streams_index.invalidate()
         self.save()
+        Subscriber.playlist_cache.invalidate(str(self.id))
 
     def get_not_active_devices(self):
         devices = []
@@ -161,9 +370,18 @@ class Subscriber(Document):
 
         return devices
 
+    def save(self, *args, **kwargs):
+        changed = not self._created and any(field.split('.')[0] in Subscriber.PLAYLIST_SOURCE_FIELDS
+                                            for field in self._get_changed_fields())
+        result = super(Subscriber, self).save(*args, **kwargs)
+        if changed:
+            ChannelChange.touch_subscribers([self.id])
+        return result
+
     def delete(self, *args, **kwargs):
         for stream in self.own_streams:
             stream.delete()
+        Subscriber.playlist_cache.invalidate(str(self.id))
         return super(Subscriber, self).delete(*args, **kwargs)
 
     @staticmethod
@@ -180,5 +398,55 @@ class Subscriber(Document):
     def check_password_hash(hash: str, password: str) -> bool:
         return hash == Subscriber.generate_password_hash(password)
 
+    # private
+    def _make_channels_snapshot(self, seq: int) -> dict:
+        channels = [stream.to_dict() for stream in self.get_streams()]
+        channels.extend(stream.to_dict() for stream in self.get_own_streams())
+        return {Subscriber.CHANGES_SEQ_FIELD: seq, Subscriber.CHANGES_SNAPSHOT_FIELD: True,
+                Subscriber.CHANGES_CHANNELS_FIELD: channels, Subscriber.CHANGES_REMOVED_FIELD: []}
+
+    @staticmethod
+    def _make_channels_delta(seq: int, channels: list, removed: list) -> dict:
+        return {Subscriber.CHANGES_SEQ_FIELD: seq, Subscriber.CHANGES_SNAPSHOT_FIELD: False,
+                Subscriber.CHANGES_CHANNELS_FIELD: channels, Subscriber.CHANGES_REMOVED_FIELD: removed}
+
+    # Position after the channel a cursor was made at, found again by id when the list changed since
+    @staticmethod
+    def _find_channels_cursor(refs: list, cursor) -> int:
+        if not cursor:
+            return 0
+
+        position, _, last_id = cursor.partition(Subscriber.CHANNELS_CURSOR_SEPARATOR)
+        position = int(position)
+        last_id = ObjectId(last_id)
+        if 0 < position <= len(refs) and IStream.ref_id(refs[position - 1]) == last_id:
+            return position
+
+        for index, ref in enumerate(refs):
+            if IStream.ref_id(ref) == last_id:
+                return index + 1
+        return min(position, len(refs))
+
+    @staticmethod
+    def _make_channels_query(group, stream_type, visible) -> dict:
+        query = {}
+        if group is not None:
+            # group holds ;-separated groups, see IStream.get_groups
+            query['group'] = {'$regex': '(^|;){0}(;|$)'.format(re.escape(group))}
+        if stream_type is not None:
+            types = [stream_type] if isinstance(stream_type, int) else stream_type
+            classes = [ServiceSettings.STREAM_CLASSES[constants.StreamType(t)] for t in types]
+            query['_cls'] = {'$in': [stream_class._class_name for stream_class in classes]}
+        if visible is not None:
+            query['visible'] = visible
+        return query
+
+    # Fields to load for the record keys, None to load everything
+    @staticmethod
+    def _make_channels_projection(fields):
+        if not fields or any(key not in IStream.DICT_SOURCE_FIELDS for key in fields):
+            return None
+        return [IStream.DICT_SOURCE_FIELDS[key] for key in fields if IStream.DICT_SOURCE_FIELDS[key]] or ['id']
+
 
 Subscriber.register_delete_rule(ServiceSettings, "subscribers", PULL)
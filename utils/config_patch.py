@@ -0,0 +1,65 @@
+import copy
+
+PATCH_SET_FIELD = 'set'
+PATCH_UNSET_FIELD = 'unset'
+PATCH_PATH_SEPARATOR = '.'
+
+
+# Smallest change turning config old into new, {} when they are equal:
+# {'set': {path: value}, 'unset': [path]} with dotted paths like 'logo.alpha' or 'input.urls.0.uri',
+# list items are addressed by index and a list that changed its length is set whole
+def make_config_patch(old: dict, new: dict) -> dict:
+    set_values = {}
+    unset = []
+    _diff_dicts(old, new, '', set_values, unset)
+
+    patch = {}
+    if set_values:
+        patch[PATCH_SET_FIELD] = set_values
+    if unset:
+        patch[PATCH_UNSET_FIELD] = unset
+    return patch
+
+
+# Copy of config with the patch applied, apply_config_patch(old, make_config_patch(old, new)) == new
+def apply_config_patch(config: dict, patch: dict) -> dict:
+    result = copy.deepcopy(config)
+    for path, value in patch.get(PATCH_SET_FIELD, {}).items():
+        parent, key = _resolve(result, path)
+        parent[key] = copy.deepcopy(value)
+    for path in patch.get(PATCH_UNSET_FIELD, []):
+        parent, key = _resolve(result, path)
+        del parent[key]
+    return result
+
+
+def _diff_dicts(old: dict, new: dict, prefix: str, set_values: dict, unset: list):
+    for key, value in new.items():
+        path = prefix + str(key)
+        if key in old:
+            _diff_values(old[key], value, path, set_values, unset)
+        else:
+            set_values[path] = value
+    for key in old:
+        if key not in new:
+            unset.append(prefix + str(key))
+
+
+def _diff_values(old, new, path: str, set_values: dict, unset: list):
+    if isinstance(old, dict) and isinstance(new, dict):
+        _diff_dicts(old, new, path + PATCH_PATH_SEPARATOR, set_values, unset)
+    elif isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        for index, (old_item, new_item) in enumerate(zip(old, new)):
+            _diff_values(old_item, new_item, path + PATCH_PATH_SEPARATOR + str(index), set_values, unset)
+    elif old != new or isinstance(old, bool) != isinstance(new, bool):  # True == 1
+        set_values[path] = new
+
+
+# (container, key or index) the last part of path addresses
+def _resolve(config: dict, path: str):
+    parts = path.split(PATCH_PATH_SEPARATOR)
+    parent = config
+    for part in parts[:-1]:
+        parent = parent[int(part)] if isinstance(parent, list) else parent[part]
+    last = parts[-1]
+    return parent, int(last) if isinstance(parent, list) else last
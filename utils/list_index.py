@@ -0,0 +1,34 @@
+# key -> position of the first item with that key, built on first use
+# a hit is checked against the item now at that position and a miss or mismatch rebuilds, lists edited directly
+# (remove one, append another) stay correct; owners invalidate() after changing the keys of items in place
+class ListIndex:
+    def __init__(self, key):
+        self._key = key
+        self._items = None
+        self._size = 0
+        self._positions = {}
+
+    def find(self, items, key) -> int:
+        if self._items is items and self._size == len(items):
+            position = self._positions.get(key, -1)
+            if position >= 0 and self._key(items[position]) == key:
+                return position
+
+        self._build(items)
+        return self._positions.get(key, -1)
+
+    def get(self, items, key, default=None):
+        position = self.find(items, key)
+        return items[position] if position >= 0 else default
+
+    def invalidate(self):
+        self._items = None
+        self._positions = {}
+
+    # private
+    def _build(self, items):
+        self._positions = {}
+        for position, item in enumerate(items):
+            self._positions.setdefault(self._key(item), position)
+        self._items = items
+        self._size = len(items)
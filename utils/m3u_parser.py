@@ -1,15 +1,233 @@
+import codecs
+import mmap
 import os
 import re
+from array import array
+from collections.abc import Mapping, Sequence
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, repeat
+
+
+class _TextColumn:
+    # mostly unique strings, utf-8 encoded back to back, a missing value is stored as ~end
+    __slots__ = ('data', 'ends')
+
+    def __init__(self):
+        self.data = bytearray()
+        self.ends = array('q')
+
+    def __getitem__(self, pos):
+        end = self.ends[pos]
+        if end < 0:
+            return None
+        start = self.ends[pos - 1] if pos else 0
+        if start < 0:
+            start = ~start
+        return self.data[start:end].decode('utf-8', errors='surrogatepass')
+
+    def append(self, value):
+        if value is None:
+            self.ends.append(~len(self.data))
+            return
+        self.data += value.encode('utf-8', errors='surrogatepass')
+        self.ends.append(len(self.data))
+
+    def extend(self, other):
+        if isinstance(other, _InternedColumn):
+            for code in other.codes:
+                self.append(other.values[code])
+            return
+        base = len(self.data)
+        self.data += other.data
+        self.ends.extend(end + base if end >= 0 else end - base for end in other.ends)
+
+    def extend_missing(self, count: int):
+        self.ends.extend(array('q', [~len(self.data)]) * count)
+
+
+class _InternedColumn:
+    # repeated strings are stored once, code 0 is a missing value
+    __slots__ = ('values', 'codes', 'lookup')
+
+    def __init__(self):
+        self.values = [None]
+        self.codes = array('I')
+        self.lookup = {}
+
+    def __getitem__(self, pos):
+        return self.values[self.codes[pos]]
+
+    def code(self, value) -> int:
+        if value is None:
+            return 0
+        code = self.lookup.get(value)
+        if code is None:
+            code = len(self.values)
+            self.values.append(value)
+            self.lookup[value] = code
+        return code
+
+    def append(self, value):
+        self.codes.append(self.code(value))
+
+    def extend(self, other):
+        if isinstance(other, _TextColumn):
+            for pos in range(len(other.ends)):
+                self.append(other[pos])
+            return
+        codes = [self.code(value) for value in other.values]
+        self.codes.extend(codes[code] for code in other.codes)
+
+    def extend_missing(self, count: int):
+        self.codes.extend(array('I', [0]) * count)
+
+    def is_worth_it(self) -> bool:
+        # mostly distinct values cost more here than in a _TextColumn
+        return len(self.values) < M3uEntries.INTERN_MIN_VALUES or len(self.values) * 2 < len(self.codes)
+
+
+class M3uEntry(Mapping):
+    # read only dict-like view of one entry stored in M3uEntries
+    __slots__ = ('_entries', '_pos')
+
+    def __init__(self, entries, pos: int):
+        self._entries = entries
+        self._pos = pos
+
+    def __getitem__(self, key):
+        column = self._entries._columns.get(key)
+        if column is not None:
+            value = column[self._pos]
+            if value is not None:
+                return value
+        raise KeyError(key)
+
+    def __iter__(self):
+        pos = self._pos
+        for key, column in self._entries._columns.items():
+            if column[pos] is not None:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def to_dict(self) -> dict:
+        return dict(self.items())
+
+
+class M3uEntries(Sequence):
+    # parsed entries stored by columns, items are M3uEntry views
+    FIELDS = ('title', 'tvg-name', 'tvg-id', 'tvg-logo', 'tvg-group', 'link')
+    TEXT_FIELDS = ('title', 'tvg-name', 'tvg-id', 'link')
+    INTERN_MIN_VALUES = 1024
+
+    def __init__(self, entries=()):
+        self._columns = {}
+        for key in M3uEntries.FIELDS:
+            self._columns[key] = _TextColumn() if key in M3uEntries.TEXT_FIELDS else _InternedColumn()
+        self._count = 0
+        self.extend(entries)
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return M3uEntries(self[pos] for pos in range(*index.indices(self._count)))
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError('entry index out of range')
+        return M3uEntry(self, index)
+
+    def append(self, entry):
+        columns = self._columns
+        for key in entry:
+            if key not in columns:
+                self._add_column(key)
+        for key, column in columns.items():
+            column.append(entry.get(key))
+        self._count += 1
+        if self._count % M3uEntries.INTERN_MIN_VALUES == 0:
+            self._demote_columns()
+
+    def extend(self, entries):
+        if not isinstance(entries, M3uEntries):
+            for entry in entries:
+                self.append(entry)
+            return
+
+        columns = self._columns
+        for key in entries._columns:
+            if key not in columns:
+                self._add_column(key)
+        for key, column in columns.items():
+            other = entries._columns.get(key)
+            if other is None:
+                column.extend_missing(entries._count)
+            else:
+                column.extend(other)
+        self._count += entries._count
+        self._demote_columns()
+
+    def values(self, key, start=0):
+        column = self._columns.get(key)
+        for pos in range(start, self._count):
+            yield column[pos] if column is not None else None
+
+    # private
+    def _add_column(self, key):
+        column = _InternedColumn()
+        column.extend_missing(self._count)
+        self._columns[key] = column
+
+    def _demote_columns(self):
+        for key, column in self._columns.items():
+            if isinstance(column, _InternedColumn) and not column.is_worth_it():
+                text = _TextColumn()
+                text.extend(column)
+                self._columns[key] = text
+
+
+class M3uFilesView(Sequence):
+    # read only selection of parsed files, nothing is copied until it is iterated
+    def __init__(self, files, positions):
+        self._files = files
+        self._positions = positions
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return M3uFilesView(self._files, self._positions[index])
+        return self._files[self._positions[index]]
+
+    def __iter__(self):
+        files = self._files
+        for pos in self._positions:
+            yield files[pos]
 
 
 class M3uParser:
+    READ_CHUNK_SIZE = 64 * 1024
+    ATTRIBUTE_PATTERN = re.compile(r'(?<![\w-])([\w-]+)="([^"]*)"')
+    UNKNOWN_VALUE = 'Unknown'
+
     def __init__(self):
-        self.files = []
+        self.files = M3uEntries()
+        self.lines = []
+        # tvg-group -> positions in files
+        self._groups = {}
+        self._indexed_files = None
+        self._indexed_count = 0
 
-    # Read the file from the given path
+    # Read the file from the given path, lines are consumed lazily by parse()
     def read_m3u(self, file_path):
-        file = open(file_path)
-        self.load_content(file.read())
+        self.lines = self.read_lines(file_path)
 
     def load_content(self, content):
         lines = []
@@ -21,61 +239,193 @@ class M3uParser:
         return len(self.lines)
 
     def parse(self):
-        numLine = len(self.lines)
-        for n in range(numLine):
-            line = self.lines[n]
-            if line[0] == '#':
-                # print("Letto carattere interessante")
-                self._manage_line(n)
+        for entry in self._iter_entries(self.lines):
+            self.files.append(entry)
+        self.lines = []
+        self._update_group_index()
+
+    # Parse a file on several processes, the result is the same as read_m3u() + parse()
+    def parse_parallel(self, file_path, workers=None):
+        if not workers:
+            workers = os.cpu_count() or 1
+
+        bounds = M3uParser._split_file(file_path, workers)
+        if len(bounds) < 3:
+            self.read_m3u(file_path)
+            self.parse()
+            return
+
+        with ProcessPoolExecutor(max_workers=len(bounds) - 1) as executor:
+            for entries in executor.map(_parse_m3u_range, repeat(file_path), bounds[:-1], bounds[1:]):
+                self.files.extend(entries)
+        self._update_group_index()
+
+    # Yield entries one by one from a path, file object or iterator of byte chunks
+    def iter_m3u(self, source):
+        return self._iter_entries(self.read_lines(source))
+
+    # Yield stripped non empty lines from a path, file object or iterator of byte chunks
+    def read_lines(self, source):
+        if isinstance(source, (str, os.PathLike)):
+            with open(source, 'rb') as file:
+                yield from self.read_lines(file)
+            return
+
+        if hasattr(source, 'read'):
+            file = source
+            source = iter(lambda: file.read(M3uParser.READ_CHUNK_SIZE), file.read(0))
+
+        # multibyte characters may be split between two chunks
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        tail = None
+        for chunk in source:
+            if isinstance(chunk, (bytes, bytearray)):
+                chunk = decoder.decode(chunk)
+            parts = chunk.split('\n')
+            if tail:
+                parts[0] = tail + parts[0]
+            tail = parts.pop()
+            for line in parts:
+                ln = line.rstrip()
+                if ln:
+                    yield ln
+
+        tail = (tail or '') + decoder.decode(b'', final=True)
+        if tail:
+            ln = tail.rstrip()
+            if ln:
+                yield ln
 
     # Getter for the list
     def get_list(self):
         return self.files
 
-    # Remove files that contains a certain filterWord
-    def filter_out_files_of_groups_containing(self, filter_word):
-        self.files = list(filter(lambda file: filter_word not in file['tvg-group'], self.files))
+    # Remove files that contains a certain filterWord, with view=True self.files is kept and a view is returned
+    def filter_out_files_of_groups_containing(self, filter_word, view=False):
+        if not isinstance(filter_word, list):
+            filter_word = [filter_word]
+        if not len(filter_word):
+            return self._select_files(range(len(self.files)), view)
+        return self._select_files(self._positions_of_groups(filter_word, False), view)
 
-    # Select only files that contais a certain filterWord
-    def filter_in_files_of_groups_containing(self, filter_word):
+    # Select only files that contais a certain filterWord, with view=True self.files is kept and a view is returned
+    def filter_in_files_of_groups_containing(self, filter_word, view=False):
         # Use the filter words as list
         if not isinstance(filter_word, list):
             filter_word = [filter_word]
         if not len(filter_word):
-            return
-        new = []
-        for file in self.files:
-            for fw in filter_word:
-                if fw in file['tvg-group']:
-                    # Allowed extension - go to next file
-                    new.append(file)
-                    break
-        self.files = new
+            return self._select_files(range(len(self.files)), view)
+        return self._select_files(self._positions_of_groups(filter_word, True), view)
 
     # private
-    def _manage_line(self, n):
-        if n + 1 < len(self.lines):
-            line_info = self.lines[n]
-            line_link = self.lines[n + 1]
-            if not line_info.startswith("#EXTM3U"):
-                m = re.search("tvg-name=\"(.*?)\"", line_info)
-                name = m.group(1) if m else 'Unknown'
-                m = re.search("tvg-id=\"(.*?)\"", line_info)
-                id = m.group(1) if m else 'Unknown'
-                m = re.search("tvg-logo=\"(.*?)\"", line_info)
-                logo = m.group(1) if m else 'Unknown'
-                m = re.search("group-title=\"(.*?)\"", line_info)
-                group = m.group(1) if m else 'Unknown'
-                m = re.search("[,](?!.*[,])(.*?)$", line_info)
-                title = m.group(1) if m else 'Unknown'
-                # ~ print(name+"||"+id+"||"+logo+"||"+group+"||"+title)
-
-                test = {
-                    'title': title,
-                    'tvg-name': name,
-                    'tvg-id': id,
-                    'tvg-logo': logo,
-                    'tvg-group': group,
-                    'link': line_link
-                }
-                self.files.append(test)
+    def _update_group_index(self):
+        files = self.files
+        if files is not self._indexed_files or len(files) < self._indexed_count:
+            self._groups = {}
+            self._indexed_files = files
+            self._indexed_count = 0
+
+        groups = self._groups
+        start = self._indexed_count
+        if isinstance(files, M3uEntries):
+            values = files.values('tvg-group', start)
+        else:
+            values = (files[pos]['tvg-group'] for pos in range(start, len(files)))
+        for pos, group in enumerate(values, start):
+            positions = groups.get(group)
+            if positions is None:
+                groups[group] = [pos]
+            else:
+                positions.append(pos)
+        self._indexed_count = len(files)
+
+    def _positions_of_groups(self, filter_words: list, contains: bool) -> list:
+        # words are matched against distinct groups only, not against every file
+        self._update_group_index()
+        search = re.compile('|'.join(re.escape(word) for word in filter_words)).search
+        selected = [positions for group, positions in self._groups.items() if bool(search(group)) == contains]
+        return sorted(chain.from_iterable(selected))
+
+    def _select_files(self, positions, view: bool):
+        if view:
+            return M3uFilesView(self.files, positions)
+        if len(positions) != len(self.files):
+            files = self.files
+            if isinstance(files, M3uEntries):
+                self.files = M3uEntries(files[pos] for pos in positions)
+            else:
+                self.files = [files[pos] for pos in positions]
+
+    @staticmethod
+    def _split_file(file_path, parts) -> list:
+        # offsets of lines starting with #EXTINF, the first one is 0 and the last one is the file size
+        size = os.path.getsize(file_path)
+        if parts < 2 or not size:
+            return [0, size]
+
+        bounds = [0]
+        with open(file_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for i in range(1, parts):
+                pos = mm.find(b'\n#EXTINF', max(size * i // parts, bounds[-1]))
+                if pos == -1:
+                    break
+                bounds.append(pos + 1)
+        bounds.append(size)
+        return bounds
+
+    def _read_range(self, mm, start: int, end: int):
+        # lines of [start, end) and, if the last one waits for a link, the first non empty line after end
+        line_info = None
+        pos = start
+        size = len(mm)
+        while pos < size:
+            if pos >= end and line_info is None:
+                break
+            nl = mm.find(b'\n', pos, size)
+            if nl == -1:
+                nl = size
+            ln = mm[pos:nl].decode('utf-8', errors='replace').rstrip()
+            in_range = pos < end
+            pos = nl + 1
+            if not ln:
+                continue
+            yield ln
+            if not in_range:
+                break
+            line_info = ln if ln[0] == '#' and not ln.startswith('#EXTM3U') else None
+
+    def _iter_entries(self, lines):
+        # every comment line except #EXTM3U describes the line that follows it
+        line_info = None
+        for line in lines:
+            if line_info is not None:
+                yield self._make_entry(line_info, line)
+            line_info = line if line[0] == '#' and not line.startswith('#EXTM3U') else None
+
+    def _make_entry(self, line_info, line_link):
+        # key="value" pairs in one pass, the first occurrence of a key wins
+        attributes = {}
+        for key, value in M3uParser.ATTRIBUTE_PATTERN.findall(line_info):
+            if key not in attributes:
+                attributes[key] = value
+        _, comma, title = line_info.rpartition(',')
+
+        entry = {
+            'title': title if comma else M3uParser.UNKNOWN_VALUE,
+            'tvg-name': attributes.pop('tvg-name', M3uParser.UNKNOWN_VALUE),
+            'tvg-id': attributes.pop('tvg-id', M3uParser.UNKNOWN_VALUE),
+            'tvg-logo': attributes.pop('tvg-logo', M3uParser.UNKNOWN_VALUE),
+            'tvg-group': attributes.pop('group-title', M3uParser.UNKNOWN_VALUE),
+            'link': line_link
+        }
+        # keep the rest (catchup, tvg-shift, tvg-chno, ...) without overriding the fields above
+        for key, value in attributes.items():
+            if key not in entry:
+                entry[key] = value
+        return entry
+
+
+def _parse_m3u_range(file_path, start: int, end: int) -> M3uEntries:
+    parser = M3uParser()
+    with open(file_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return M3uEntries(parser._iter_entries(parser._read_range(mm, start, end)))
@@ -0,0 +1,180 @@
+import gzip
+from collections import OrderedDict
+from hashlib import md5
+from threading import Lock
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+PLAYLIST_HEADER = '#EXTM3U\n'
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+GZIP_ENCODING = 'gzip'
+ZSTD_ENCODING = 'zstd'
+GZIP_COMPRESS_LEVEL = 9
+ZSTD_COMPRESS_LEVEL = 3
+# preferred first, zstd only when zstandard is installed
+PLAYLIST_ENCODINGS = (ZSTD_ENCODING, GZIP_ENCODING) if zstandard else (GZIP_ENCODING,)
+
+
+# Join text fragments into encoded chunks of about chunk_size characters
+def encode_chunks(fragments, chunk_size=DEFAULT_CHUNK_SIZE, encoding='utf-8'):
+    buffer = []
+    size = 0
+    for fragment in fragments:
+        buffer.append(fragment)
+        size += len(fragment)
+        if size >= chunk_size:
+            yield ''.join(buffer).encode(encoding)
+            buffer = []
+            size = 0
+
+    if buffer:
+        yield ''.join(buffer).encode(encoding)
+
+
+# Compressed once, so the slow levels are affordable, gzip without mtime to stay byte identical
+def compress_playlist(content: bytes, encoding: str) -> bytes:
+    if encoding == GZIP_ENCODING:
+        return gzip.compress(content, GZIP_COMPRESS_LEVEL, mtime=0)
+    if encoding == ZSTD_ENCODING and zstandard:
+        return zstandard.ZstdCompressor(level=ZSTD_COMPRESS_LEVEL).compress(content)
+    raise ValueError('Unsupported playlist encoding: {0}'.format(encoding))
+
+
+# Best of available encodings allowed by an Accept-Encoding header, None for identity
+def select_encoding(accept_encoding: str, available=PLAYLIST_ENCODINGS):
+    if not accept_encoding:
+        return None
+
+    qualities = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.partition(';')
+        quality = 1.0
+        key, _, value = params.partition('=')
+        if key.strip().lower() == 'q':
+            try:
+                quality = float(value)
+            except ValueError:
+                quality = 0.0
+        qualities[name.strip().lower()] = quality
+
+    selected = None
+    selected_quality = 0.0
+    for encoding in PLAYLIST_ENCODINGS:
+        if encoding not in available:
+            continue
+        quality = qualities.get(encoding, qualities.get('*', 0.0))
+        if quality > selected_quality:
+            selected = encoding
+            selected_quality = quality
+    return selected
+
+
+class PlaylistTemplate:
+    # fixed text kept as encoded parts, slots are filled by render()
+    DEVICE_ID = 'did'
+    LB_HOST = 'lb_server_host_and_port'
+
+    def __init__(self, version: str):
+        self.version = version
+        self._parts = []
+        self._slots = []
+        self._pending = []
+
+    def append(self, text: str):
+        self._pending.append(text)
+
+    def append_slot(self, name: str):
+        self._flush()
+        self._slots.append((len(self._parts), name))
+        self._parts.append(b'')
+
+    def render(self, **values) -> bytes:
+        self._flush()
+        parts = list(self._parts)
+        encoded = {name: value.encode() for name, value in values.items()}
+        for index, name in self._slots:
+            parts[index] = encoded[name]
+        return b''.join(parts)
+
+    # private
+    def _flush(self):
+        if self._pending:
+            self._parts.append(''.join(self._pending).encode())
+            self._pending = []
+
+
+class CachedPlaylist:
+    __slots__ = ('version', 'etag', 'content', 'encoded')
+
+    def __init__(self, version: str, content: bytes):
+        self.version = version
+        self.etag = md5(content).hexdigest()
+        self.content = content
+        self.encoded = {}
+
+    # Compressed content, made on first use and kept as long as this version is cached
+    def get_encoded(self, encoding: str) -> bytes:
+        encoded = self.encoded.get(encoding)
+        if encoded is None:
+            encoded = compress_playlist(self.content, encoding)
+            self.encoded[encoding] = encoded
+        return encoded
+
+    # (encoding, bytes) for the response, encoding is None when the client accepts none of ours
+    def negotiate(self, accept_encoding: str):
+        encoding = select_encoding(accept_encoding)
+        if encoding is None:
+            return None, self.content
+        return encoding, self.get_encoded(encoding)
+
+    def compress_all(self) -> dict:
+        return {encoding: self.get_encoded(encoding) for encoding in PLAYLIST_ENCODINGS}
+
+
+# LRU of rendered playlists or templates, an item is only returned for the version it was made from
+class PlaylistCache:
+    DEFAULT_MAX_SIZE = 1024
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._keys_by_owner = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, owner, key, version: str):
+        with self._lock:
+            cached = self._entries.get((owner, key))
+            if cached is None or cached.version != version:
+                return None
+            self._entries.move_to_end((owner, key))
+            return cached
+
+    def put(self, owner, key, item):
+        with self._lock:
+            self._entries[(owner, key)] = item
+            self._entries.move_to_end((owner, key))
+            self._keys_by_owner.setdefault(owner, set()).add(key)
+            while len(self._entries) > self.max_size:
+                (old_owner, old_key), _ = self._entries.popitem(last=False)
+                self._forget(old_owner, old_key)
+        return item
+
+    def invalidate(self, owner):
+        with self._lock:
+            for key in self._keys_by_owner.pop(owner, ()):
+                self._entries.pop((owner, key), None)
+
+    # private
+    def _forget(self, owner, key):
+        keys = self._keys_by_owner.get(owner)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_owner[owner]
@@ -0,0 +1,162 @@
+import json
+import mmap
+import os
+import struct
+import tempfile
+from collections import OrderedDict
+from hashlib import md5
+from threading import Lock
+
+from app.common.utils.playlist import select_encoding
+
+
+class StoredPlaylist:
+    IDENTITY = 'identity'
+
+    def __init__(self, version: str, etag: str, sections: dict):
+        self.version = version
+        self.etag = etag
+        self.sections = sections
+
+    @property
+    def content(self) -> memoryview:
+        return self.sections[StoredPlaylist.IDENTITY]
+
+    def get_section(self, name: str):
+        return self.sections.get(name)
+
+    # (encoding, view) of the best precompressed section the client accepts, plain content otherwise
+    def negotiate(self, accept_encoding: str):
+        encoding = select_encoding(accept_encoding, self.sections)
+        if encoding is None:
+            return None, self.content
+        return encoding, self.sections[encoding]
+
+
+# Prerendered playlists shared by all worker processes through the page cache
+#
+# One file per key: the sections (plain playlist and optional encoded forms) followed by a json index of
+# offsets and a fixed footer. A publish writes a temporary file and renames it over the old one, readers
+# map the file read-only and notice a swap on the next get(). Every mapping holds a file descriptor, so only
+# the max_mapped most recently read keys stay mapped, an evicted mapping is closed once no caller uses its views.
+class PlaylistStore:
+    FILE_EXTENSION = '.pls'
+    MAGIC = b'PLS1'
+    FOOTER = struct.Struct('<Q4s')
+    INDEX_VERSION_FIELD = 'version'
+    INDEX_ETAG_FIELD = 'etag'
+    INDEX_SECTIONS_FIELD = 'sections'
+    DEFAULT_MAX_MAPPED = 64
+
+    _stores = {}
+    _stores_lock = Lock()
+
+    def __init__(self, directory: str, max_mapped=DEFAULT_MAX_MAPPED):
+        self.directory = directory
+        self.max_mapped = max_mapped
+        self._mapped = OrderedDict()  # key -> (signature, StoredPlaylist), least recently read first
+        self._lock = Lock()
+
+    # One store per directory in a process, so mappings are shared between callers
+    @classmethod
+    def open(cls, directory: str):
+        directory = os.path.abspath(os.path.expanduser(directory))
+        with cls._stores_lock:
+            store = cls._stores.get(directory)
+            if store is None:
+                store = cls(directory)
+                cls._stores[directory] = store
+            return store
+
+    # content is bytes or an iterable of encoded chunks, encoded are extra named sections
+    def publish(self, key: str, content, version: str, **encoded) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                sections = {}
+                digest = md5()
+                for chunk in ((content,) if isinstance(content, (bytes, bytearray, memoryview)) else content):
+                    file.write(chunk)
+                    digest.update(chunk)
+                sections[StoredPlaylist.IDENTITY] = [0, file.tell()]
+                offset = file.tell()
+                for name, data in encoded.items():
+                    file.write(data)
+                    sections[name] = [offset, len(data)]
+                    offset += len(data)
+
+                etag = digest.hexdigest()
+                index = {PlaylistStore.INDEX_VERSION_FIELD: version, PlaylistStore.INDEX_ETAG_FIELD: etag,
+                         PlaylistStore.INDEX_SECTIONS_FIELD: sections}
+                file.write(json.dumps(index, separators=(',', ':')).encode())
+                file.write(PlaylistStore.FOOTER.pack(offset, PlaylistStore.MAGIC))
+                file.flush()
+                os.fsync(file.fileno())
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return etag
+
+    def get(self, key: str):
+        path = self._path(key)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self._forget(key)
+            return None
+
+        signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            mapped = self._mapped.get(key)
+            if mapped is not None and mapped[0] == signature:
+                self._mapped.move_to_end(key)
+                return mapped[1]
+
+        try:
+            stored = self._map(path)
+        except FileNotFoundError:
+            return None
+
+        with self._lock:
+            self._mapped[key] = (signature, stored)
+            self._mapped.move_to_end(key)
+            while len(self._mapped) > self.max_mapped:
+                self._mapped.popitem(last=False)
+        return stored
+
+    def remove(self, key: str):
+        self._forget(key)
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    # private
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key.replace(os.sep, '_') + PlaylistStore.FILE_EXTENSION)
+
+    def _forget(self, key: str):
+        with self._lock:
+            self._mapped.pop(key, None)
+
+    @staticmethod
+    def _map(path: str) -> StoredPlaylist:
+        with open(path, 'rb') as file:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # the mapping stays valid after a swap, it is unmapped once the last view is gone
+        view = memoryview(buffer)
+        footer_offset = len(view) - PlaylistStore.FOOTER.size
+        index_offset, magic = PlaylistStore.FOOTER.unpack(view[footer_offset:])
+        if magic != PlaylistStore.MAGIC:
+            raise ValueError('Invalid playlist file: {0}'.format(path))
+
+        index = json.loads(bytes(view[index_offset:footer_offset]))
+        sections = {name: view[offset:offset + length] for name, (offset, length) in
+                    index[PlaylistStore.INDEX_SECTIONS_FIELD].items()}
+        return StoredPlaylist(index[PlaylistStore.INDEX_VERSION_FIELD], index[PlaylistStore.INDEX_ETAG_FIELD],
+                              sections)
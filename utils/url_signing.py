@@ -0,0 +1,66 @@
+import hashlib
+import hmac
+import time
+
+# Signed device urls keep the layout of the password ones: http://lb/uid/token/did/sid/oid/file
+# where token is kid.expires.signature, signed over uid/did/sid/oid/expires. The file name is left out
+# so the same token covers every segment of the stream.
+TOKEN_SEPARATOR = '.'
+SIGNATURE_LENGTH = 32
+
+
+def _make_mac(secret: bytes):
+    return hmac.new(secret, digestmod=hashlib.sha256)
+
+
+def _sign(mac, uid: str, did: str, sid: str, oid: str, expires: str) -> str:
+    mac = mac.copy()
+    mac.update('/'.join((uid, did, sid, oid, expires)).encode())
+    return mac.hexdigest()[:SIGNATURE_LENGTH]
+
+
+class DeviceUrlSigner:
+    def __init__(self, kid: str, secret: bytes, expires: int):
+        self.kid = kid
+        self.expires = expires
+        self._mac = _make_mac(secret)
+
+    def make_token(self, uid: str, did: str, sid: str, oid: str) -> str:
+        signature = _sign(self._mac, uid, did, sid, oid, str(self.expires))
+        return TOKEN_SEPARATOR.join((self.kid, str(self.expires), signature))
+
+    # link is sid/oid/file as stored in IStream.device_links
+    def make_url(self, lb_server_host_and_port: str, uid: str, did: str, link: str) -> str:
+        sid, oid, _ = link.split('/', 2)
+        token = self.make_token(uid, did, sid, oid)
+        return 'http://{0}/{1}/{2}/{3}/{4}'.format(lb_server_host_and_port, uid, token, did, link)
+
+
+# Checks request paths without any database access, keys is kid -> secret (ServiceSettings.get_signing_keys)
+class DeviceUrlVerifier:
+    def __init__(self, keys: dict):
+        self._macs = {kid: _make_mac(secret) for kid, secret in keys.items()}
+
+    # (uid, did, sid, oid) of a valid unexpired path, None otherwise
+    def verify(self, path: str, now=None):
+        parts = path.lstrip('/').split('/', 5)
+        if len(parts) != 6:
+            return None
+
+        uid, token, did, sid, oid, _ = parts
+        fields = token.split(TOKEN_SEPARATOR)
+        if len(fields) != 3:
+            return None
+
+        kid, expires, signature = fields
+        mac = self._macs.get(kid)
+        if mac is None or not (expires.isascii() and expires.isdigit()):
+            return None
+
+        if int(expires) < (time.time() if now is None else now):
+            return None
+
+        # compare_digest() raises TypeError for non-ASCII str, signatures are hex
+        if not signature.isascii() or not hmac.compare_digest(signature, _sign(mac, uid, did, sid, oid, expires)):
+            return None
+        return uid, did, sid, oid